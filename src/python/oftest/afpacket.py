@@ -6,18 +6,64 @@ in the data returned by recv. Instead, it delivers the VLAN TCI in a control
 message. Python 2.x doesn't have built-in support for recvmsg, so we have to
 use ctypes to call it. The recv function exported by this module reconstructs
 the VLAN tag if it was offloaded.
+
+Receiver does the same for many packets per system call with recvmmsg,
+reusing buffers allocated once per socket.
+
+RxRing is an alternative to recv which maps a TPACKET_V3 receive ring
+shared with the kernel. Packets are read straight out of the ring, with no
+system call or buffer allocation per packet. The kernel reports the VLAN
+TCI in the header of each packet in the ring.
 """
 
 import os
 import socket
 import errno
 import struct
+import mmap
+import select
+import time
 from ctypes import *
 
 ETH_P_8021Q = 0x8100
 SOL_PACKET = 263
+PACKET_RX_RING = 5
 PACKET_AUXDATA = 8
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1 << 0
 TP_STATUS_VLAN_VALID = 1 << 4
+TP_STATUS_VLAN_TPID_VALID = 1 << 6
+
+# Max number of messages passed to one sendmmsg call
+SEND_BATCH = 1024
+
+# Seconds send_many waits for a full transmit queue to take a packet
+SEND_TIMEOUT = 1.0
+
+# Default max number of packets returned by one Receiver.recv call
+RECV_BATCH = 64
+
+MSG_DONTWAIT = 0x40
+
+# Default RX ring geometry: 64 blocks of 256KB.  A block is handed to
+# userspace when it is full or RING_RETIRE_TOV milliseconds after its
+# first packet arrived.
+RING_BLOCK_SIZE = 1 << 18
+RING_BLOCK_NR = 64
+RING_FRAME_SIZE = 1 << 11
+RING_RETIRE_TOV = 10
+
+# struct tpacket_block_desc: block_status, num_pkts, offset_to_first_pkt
+# of the tpacket_hdr_v1 following the version and offset_to_priv fields
+BLOCK_DESC = struct.Struct("=III")
+BLOCK_DESC_OFFSET = 8
+
+# struct tpacket3_hdr: tp_next_offset, tp_sec, tp_nsec, tp_snaplen,
+# tp_len, tp_status, tp_mac, tp_net, and the tpacket_hdr_variant1 fields
+# tp_rxhash, tp_vlan_tci, tp_vlan_tpid
+TPACKET3_HDR = struct.Struct("=IIIIIIHHIIH")
 
 class struct_iovec(Structure):
     _fields_ = [
@@ -36,6 +82,12 @@ class struct_msghdr(Structure):
         ("msg_flags", c_int),
     ]
 
+class struct_mmsghdr(Structure):
+    _fields_ = [
+        ("msg_hdr", struct_msghdr),
+        ("msg_len", c_uint),
+    ]
+
 class struct_cmsghdr(Structure):
     _fields_ = [
         ("cmsg_len", c_size_t),
@@ -43,6 +95,17 @@ class struct_cmsghdr(Structure):
         ("cmsg_type", c_int),
     ]
 
+class struct_tpacket_req3(Structure):
+    _fields_ = [
+        ("tp_block_size", c_uint),
+        ("tp_block_nr", c_uint),
+        ("tp_frame_size", c_uint),
+        ("tp_frame_nr", c_uint),
+        ("tp_retire_blk_tov", c_uint),
+        ("tp_sizeof_priv", c_uint),
+        ("tp_feature_req_word", c_uint),
+    ]
+
 class struct_tpacket_auxdata(Structure):
     _fields_ = [
         ("tp_status", c_uint),
@@ -59,6 +122,14 @@ recvmsg = libc.recvmsg
 recvmsg.argtypes = [c_int, POINTER(struct_msghdr), c_int]
 recvmsg.retype = c_int
 
+recvmmsg = libc.recvmmsg
+recvmmsg.argtypes = [c_int, POINTER(struct_mmsghdr), c_uint, c_int, c_void_p]
+recvmmsg.restype = c_int
+
+sendmmsg = libc.sendmmsg
+sendmmsg.argtypes = [c_int, POINTER(struct_mmsghdr), c_uint, c_int]
+sendmmsg.restype = c_int
+
 # the above recvmsg uses libc c function call,
 # to get the errno, use external libc errno global variable, __errno_location
 get_errno_loc = libc.__errno_location
@@ -125,3 +196,212 @@ def recv(sk, bufsize):
         return buf.raw[:12] + tag + buf.raw[12:rv]
     else:
         return buf.raw[:rv]
+
+class Receiver(object):
+    """
+    Batched receive from an AF_PACKET socket
+
+    The data and control buffers, iovecs and message headers for up to
+    batch packets are allocated once.  Each recv call takes all waiting
+    packets, up to the batch size, with one recvmmsg call.
+
+    enable_auxdata must have been called on the socket.
+    """
+
+    def __init__(self, sk, bufsize, batch=RECV_BATCH):
+        """
+        @param sk Socket
+        @param bufsize Maximum packet size
+        @param batch Max number of packets per recv call
+        """
+        self.sk = sk
+        self.bufsize = bufsize
+        self.batch = batch
+        self.ctrl_bufsize = sizeof(struct_cmsghdr) + sizeof(struct_tpacket_auxdata) + sizeof(c_size_t)
+        self.data = create_string_buffer(bufsize * batch)
+        self.ctrl = create_string_buffer(self.ctrl_bufsize * batch)
+        self.iovs = (struct_iovec * batch)()
+        self.msgs = (struct_mmsghdr * batch)()
+        data_base = addressof(self.data)
+        ctrl_base = addressof(self.ctrl)
+        for i in range(batch):
+            self.iovs[i].iov_base = data_base + i * bufsize
+            self.iovs[i].iov_len = bufsize
+            msghdr = self.msgs[i].msg_hdr
+            msghdr.msg_iov = pointer(self.iovs[i])
+            msghdr.msg_iovlen = 1
+            msghdr.msg_control = ctrl_base + i * self.ctrl_bufsize
+
+    def recv(self, count=None):
+        """
+        Receive the packets waiting on the socket without blocking
+
+        @param count Max number of packets, at most the batch size; the
+        batch size if None
+        @returns A list of packet data strings, possibly empty
+        """
+        if count is None or count > self.batch:
+            count = self.batch
+        for i in range(count):
+            # The kernel overwrites these with the returned lengths
+            self.msgs[i].msg_hdr.msg_controllen = self.ctrl_bufsize
+            self.msgs[i].msg_hdr.msg_flags = 0
+
+        rv = recvmmsg(self.sk.fileno(), self.msgs, count, MSG_DONTWAIT, None)
+        if rv < 0:
+            e = get_errno_loc()[0]
+            if e in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            if e == errno.ENETDOWN:
+                raise OSError(errno.ENETDOWN, "Connection Down", self.sk.fileno())
+            raise RuntimeError("recvmmsg failed: errno=%d" % e)
+
+        pkts = []
+        data_base = addressof(self.data)
+        for i in range(rv):
+            length = self.msgs[i].msg_len
+            pkt = string_at(data_base + i * self.bufsize, length)
+            if self.msgs[i].msg_hdr.msg_controllen >= sizeof(struct_cmsghdr):
+                # PACKET_AUXDATA is the only control message enabled
+                offset = i * self.ctrl_bufsize + sizeof(struct_cmsghdr)
+                auxdata = struct_tpacket_auxdata.from_buffer(self.ctrl, offset) # pylint: disable=E1101
+                if auxdata.tp_vlan_tci != 0 or auxdata.tp_status & TP_STATUS_VLAN_VALID:
+                    # Insert VLAN tag
+                    tag = struct.pack("!HH", ETH_P_8021Q, auxdata.tp_vlan_tci)
+                    pkt = pkt[:12] + tag + pkt[12:]
+            pkts.append(pkt)
+        return pkts
+
+def send_many(sk, packets):
+    """
+    Send packets on an AF_PACKET socket with as few system calls as possible
+
+    Up to SEND_BATCH packets are passed to each sendmmsg call.  While the
+    transmit queue is full the call is retried, for up to SEND_TIMEOUT
+    seconds without progress.
+    @sk Bound socket
+    @packets List of packet data strings
+    @returns The number of packets sent
+    @raises socket.error if the transmit queue stays full
+    """
+    sent = 0
+    while sent < len(packets):
+        batch = packets[sent:sent + SEND_BATCH]
+        count = len(batch)
+        iovs = (struct_iovec * count)()
+        msgs = (struct_mmsghdr * count)()
+        for i, pkt in enumerate(batch):
+            # c_char_p points into the string itself; batch keeps it alive
+            iovs[i].iov_base = cast(c_char_p(pkt), c_void_p)
+            iovs[i].iov_len = len(pkt)
+            msgs[i].msg_hdr.msg_iov = pointer(iovs[i])
+            msgs[i].msg_hdr.msg_iovlen = 1
+
+        done = 0
+        deadline = time.time() + SEND_TIMEOUT
+        while done < count:
+            rv = sendmmsg(sk.fileno(), pointer(msgs[done]), count - done, 0)
+            if rv < 0:
+                e = get_errno_loc()[0]
+                if e in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    if time.time() >= deadline:
+                        raise socket.error(e, os.strerror(e))
+                    # Transmit queue full; wait for it to drain
+                    select.select([], [sk], [], 0.001)
+                    continue
+                if e == errno.ENETDOWN:
+                    raise OSError(errno.ENETDOWN, "Connection Down", sk.fileno())
+                raise RuntimeError("sendmmsg failed: errno=%d" % e)
+            done += rv
+            deadline = time.time() + SEND_TIMEOUT
+        sent += count
+    return sent
+
+class RxRing(object):
+    """
+    TPACKET_V3 receive ring of an AF_PACKET socket
+
+    The kernel fills the blocks of the ring in order and marks each one
+    TP_STATUS_USER when it is done with it.  The socket is readable
+    while such a block is waiting.  Packets are taken from the current
+    block one by one; once all have been taken the block is given back
+    to the kernel.
+
+    The ring must be set up before the socket is bound.
+    """
+
+    def __init__(self, sk, block_size=RING_BLOCK_SIZE,
+                 block_nr=RING_BLOCK_NR, frame_size=RING_FRAME_SIZE,
+                 retire_tov=RING_RETIRE_TOV):
+        """
+        @param sk AF_PACKET socket
+        @param block_size Size of a block; a multiple of the page size
+        @param block_nr Number of blocks
+        @param frame_size Nominal frame size, used to size the ring
+        @param retire_tov Milliseconds before a partly filled block is
+        handed to userspace
+        """
+        sk.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+
+        req = struct_tpacket_req3()
+        req.tp_block_size = block_size
+        req.tp_block_nr = block_nr
+        req.tp_frame_size = frame_size
+        req.tp_frame_nr = block_size * block_nr // frame_size
+        req.tp_retire_blk_tov = retire_tov
+        sk.setsockopt(SOL_PACKET, PACKET_RX_RING,
+                      string_at(addressof(req), sizeof(req)))
+
+        self.map = mmap.mmap(sk.fileno(), block_size * block_nr,
+                             mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self.block_size = block_size
+        self.block_nr = block_nr
+        self.block = 0 # Index of the current block
+        self.remaining = 0 # Packets not yet taken from the current block
+        self.offset = 0 # Offset of the next packet in the map
+
+    def recv(self):
+        """
+        Take the next packet from the ring
+
+        @retval (packet data, timestamp), or (None, None) if no packet is
+        waiting
+        """
+        while self.remaining == 0:
+            base = self.block * self.block_size
+            status, num_pkts, first = \
+                BLOCK_DESC.unpack_from(self.map, base + BLOCK_DESC_OFFSET)
+            if not status & TP_STATUS_USER:
+                return (None, None)
+            self.remaining = num_pkts
+            self.offset = base + first
+            if num_pkts == 0:
+                self._release()
+
+        (next_offset, sec, nsec, snaplen, _, status, mac, _, _,
+         vlan_tci, vlan_tpid) = TPACKET3_HDR.unpack_from(self.map, self.offset)
+        start = self.offset + mac
+        pkt = self.map[start:start + snaplen]
+        if vlan_tci != 0 or status & TP_STATUS_VLAN_VALID:
+            # Insert VLAN tag
+            if not status & TP_STATUS_VLAN_TPID_VALID:
+                vlan_tpid = ETH_P_8021Q
+            pkt = pkt[:12] + struct.pack("!HH", vlan_tpid, vlan_tci) + pkt[12:]
+
+        self.remaining -= 1
+        if self.remaining:
+            self.offset += next_offset
+        else:
+            self._release()
+        return (pkt, sec + nsec * 1e-9)
+
+    def close(self):
+        self.map.close()
+
+    def _release(self):
+        # Give the current block back to the kernel and move to the next
+        base = self.block * self.block_size
+        struct.pack_into("=I", self.map, base + BLOCK_DESC_OFFSET,
+                         TP_STATUS_KERNEL)
+        self.block = (self.block + 1) % self.block_nr
+        self.remaining = 0
@@ -12,9 +12,91 @@ import os
 import oftest
 from oftest import config
 import oftest.controller as controller
+import oftest.transport as transport
 import oftest.dataplane as dataplane
 import ofp
 
+# (controller, features_reply) kept connected across tests when
+# config["session_controller"] is set
+_session = None
+
+def connect_controller():
+    """
+    Start a controller, wait for the switch and do the features handshake
+
+    @returns A pair (controller, features_reply).  The reply is None if
+    the switch did not answer the features request.
+    """
+    if config["unix_socket"] != None:
+        cxn_transport = transport.UnixTransport(config["unix_socket"])
+    else:
+        cxn_transport = None
+    con = controller.Controller(
+        switch=config["switch_ip"],
+        host=config["controller_host"],
+        port=config["controller_port"],
+        dispatch_workers=config["dispatch_workers"],
+        transport=cxn_transport)
+    con.start()
+
+    try:
+        #@todo Add an option to wait for a pkt transaction to ensure version
+        # compatibilty?
+        con.connect(timeout=20)
+
+        # By default, respond to echo requests
+        con.keep_alive = True
+
+        if not con.active:
+            raise Exception("Controller startup failed")
+        if con.switch_addr is None:
+            raise Exception("Controller startup failed (no switch addr)")
+        logging.info("Connected " + str(con.switch_addr))
+        request = ofp.message.features_request()
+        reply, pkt = con.transact(request)
+    except:
+        con.kill()
+        raise
+    return (con, reply)
+
+def session_controller_get():
+    """
+    Return the session controller, connecting it if needed
+
+    A session controller that is still connected is reset to a clean
+    per-test state.  If the switch has disconnected, or the reset fails,
+    a new controller is started.
+
+    @returns A pair (controller, features_reply) as for connect_controller
+    """
+    global _session
+    if _session:
+        con, reply = _session
+        if con.active and con.switch_socket:
+            if con.reset():
+                con.keep_alive = True
+                return _session
+            logging.info("Session controller reset failed, reconnecting")
+        else:
+            logging.info("Session controller disconnected, reconnecting")
+        session_controller_close()
+
+    con, reply = connect_controller()
+    if reply is not None:
+        _session = (con, reply)
+    return (con, reply)
+
+def session_controller_close():
+    """
+    Shut down the session controller, if any
+    """
+    global _session
+    if _session:
+        con, reply = _session
+        _session = None
+        con.shutdown()
+        con.join()
+
 class BaseTest(unittest.TestCase):
     def __str__(self):
         return self.id().replace('.runTest', '')
@@ -29,42 +111,45 @@ class BaseTest(unittest.TestCase):
 class SimpleProtocol(BaseTest):
     """
     Root class for setting up the controller
+
+    With config["session_controller"] set the switch connection is shared
+    by all tests and only reset between them.  Tests decorated with
+    testutils.fresh_controller always get their own connection.
     """
 
     def setUp(self):
         BaseTest.setUp(self)
 
-        self.controller = controller.Controller(
-            switch=config["switch_ip"],
-            host=config["controller_host"],
-            port=config["controller_port"])
-        self.controller.start()
+        self.session = (config["session_controller"] and
+                        not getattr(self, "_fresh_controller", False))
+        if self.session:
+            self.controller, reply = session_controller_get()
+        else:
+            self.controller, reply = connect_controller()
 
         try:
-            #@todo Add an option to wait for a pkt transaction to ensure version
-            # compatibilty?
-            self.controller.connect(timeout=20)
-
-            # By default, respond to echo requests
-            self.controller.keep_alive = True
-
-            if not self.controller.active:
-                raise Exception("Controller startup failed")
-            if self.controller.switch_addr is None:
-                raise Exception("Controller startup failed (no switch addr)")
-            logging.info("Connected " + str(self.controller.switch_addr))
-            request = ofp.message.features_request()
-            reply, pkt = self.controller.transact(request)
             self.assertTrue(reply is not None,
                             "Did not complete features_request for handshake")
-            if reply.version == 1:
-                self.supported_actions = reply.actions
-                logging.info("Supported actions: " + hex(self.supported_actions))
         except:
+            # A session controller without a features reply was never
+            # stored, so session_controller_close would not stop it
+            if self.session:
+                session_controller_close()
             self.controller.kill()
             del self.controller
             raise
 
+        if reply.version == 1:
+            self.supported_actions = reply.actions
+            logging.info("Supported actions: " + hex(self.supported_actions))
+
+        if config["control_pcap"]:
+            if config["log_dir"] != None:
+                filename = os.path.join(config["log_dir"], str(self))
+            else:
+                filename = os.path.splitext(config["log_file"])[0] + "-" + str(self)
+            self.controller.start_capture(filename + ".control.pcap")
+
     def inheritSetup(self, parent):
         """
         Inherit the setup of a parent
@@ -84,10 +169,14 @@ class SimpleProtocol(BaseTest):
                           + str(parent))
         self.controller = parent.controller
         self.supported_actions = parent.supported_actions
+        self.session = parent.session
         
     def tearDown(self):
-        self.controller.shutdown()
-        self.controller.join()
+        self.controller.stats_dump(level=logging.DEBUG)
+        self.controller.stop_capture()
+        if not self.session:
+            self.controller.shutdown()
+            self.controller.join()
         del self.controller
         BaseTest.tearDown(self)
 
@@ -103,7 +192,11 @@ class SimpleDataPlane(SimpleProtocol):
     def setUp(self):
         SimpleProtocol.setUp(self)
         self.dataplane = oftest.dataplane_instance
+        self.dataplane.queue_len_reset()
+        if hasattr(self, "_dataplane_queue_len"):
+            self.dataplane.queue_len_set(self._dataplane_queue_len)
         self.dataplane.flush()
+        self.dataplane.queue_stats_reset()
         if config["log_dir"] != None:
             filename = os.path.join(config["log_dir"], str(self)) + ".pcap"
             self.dataplane.start_pcap(filename)
@@ -130,7 +223,11 @@ class DataPlaneOnly(BaseTest):
     def setUp(self):
         BaseTest.setUp(self)
         self.dataplane = oftest.dataplane_instance
+        self.dataplane.queue_len_reset()
+        if hasattr(self, "_dataplane_queue_len"):
+            self.dataplane.queue_len_set(self._dataplane_queue_len)
         self.dataplane.flush()
+        self.dataplane.queue_stats_reset()
         if config["log_dir"] != None:
             filename = os.path.join(config["log_dir"], str(self)) + ".pcap"
             self.dataplane.start_pcap(filename)
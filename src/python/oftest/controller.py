@@ -15,14 +15,9 @@ poll calls.
 
 Callbacks and polling support specifying the message type
 
-@todo Support transaction semantics via xid
-@todo Support select and listen on an administrative socket (or
-use a timeout to support clean shutdown).
-
-Currently only one connection is accepted during the life of
-the controller.   There seems
-to be no clean way to interrupt an accept call.  Using select that also listens
-on an administrative socket and can shut down the socket might work.
+By default only one connection is accepted during the life of the
+controller.  With max_connections greater than one the listening socket
+stays open and each switch connection gets its own Connection object.
 
 """
 
@@ -31,13 +26,19 @@ import os
 import socket
 import time
 import struct
-import select
 import logging
+import itertools
+import Queue
 from threading import Thread
 from threading import Lock
 from threading import Condition
+from collections import deque
 
 import ofutils
+import reactor
+import stats
+from transport import TcpTransport
+from pcap_writer import ControlCapture
 import loxi
 
 # Configured openflow version
@@ -66,6 +67,71 @@ def hex_dump_buffer(src, length=16):
 RCV_SIZE_DEFAULT = 32768
 LISTEN_QUEUE_SIZE = 1
 
+# Corked output is written once this many bytes are pending
+TX_FLUSH_SIZE = 65536
+
+# Messages waiting for a dispatch worker; data messages (packet-ins)
+# arriving when a worker's queue is full are dropped
+DISPATCH_QUEUE_SIZE = 1024
+
+# Size of the packet-in ring of each connection's message queue
+MAX_PKT_INS = 1024
+
+# Seconds reset waits for the barrier flushing a test's in-flight replies
+RESET_BARRIER_TIMEOUT = 2
+
+# Default number of events held by an EventStream
+EVENT_STREAM_SIZE = 1024
+
+# OpenFlow header: version, type, length, xid
+OFP_HEADER = struct.Struct("!BBHL")
+
+# Start of an error message body: type, code
+ERROR_HEADER = struct.Struct("!HH")
+
+# Errors of each (type, code) logged per connection before only counting
+ERROR_LOG_LIMIT = 10
+
+# Error type of experimenter errors in OpenFlow 1.2+
+OFPET_EXPERIMENTER = 0xffff
+
+# Default packet-in filter: burst and packets per second allowed per
+# connection/port/reason
+PKT_IN_FILTER_LIMIT = 50
+PKT_IN_FILTER_RATE = 100
+
+# Number of leading payload bytes hashed to recognize expected packet-ins.
+# Packet-in data may be truncated by the switch, so only a prefix is used.
+PKT_IN_EXPECT_LEN = 64
+
+# OFPSF_REPLY_MORE / OFPMPF_REPLY_MORE, the same in all OpenFlow versions
+MULTIPART_REPLY_MORE = 1
+
+# Message types with the same value in all OpenFlow versions, used before
+# a message is decoded
+OFPT_ECHO_REQUEST = 2
+OFPT_ECHO_REPLY = 3
+OFPT_PACKET_IN = 10
+OFPT_FLOW_REMOVED = 11
+OFPT_PORT_STATUS = 12
+
+# Queue priorities.  When the message queue is full a message may only
+# evict messages of the same or lower priority, so replies are never
+# pushed out by a flood of asynchronous messages.
+QUEUE_PRIORITY_DATA = 0
+QUEUE_PRIORITY_ASYNC = 1
+QUEUE_PRIORITY_REPLY = 2
+
+# Queue priority by message type; others are QUEUE_PRIORITY_REPLY
+QUEUE_PRIORITIES = {
+    OFPT_PACKET_IN: QUEUE_PRIORITY_DATA,
+    OFPT_FLOW_REMOVED: QUEUE_PRIORITY_ASYNC,
+    OFPT_PORT_STATUS: QUEUE_PRIORITY_ASYNC,
+}
+
+# OXM header of an unmasked OFPXMT_OFB_IN_PORT field
+OXM_IN_PORT = 0x80000004
+
 class Controller(Thread):
     """
     Class abstracting the control interface to the switch.  
@@ -79,11 +145,27 @@ class Controller(Thread):
     and host byte order.  'Above' this object, things should be in host
     byte order.
 
+    The controller may hold connections from several switches, or
+    several connections from one switch (OpenFlow 1.3+ auxiliary
+    connections), up to max_connections.  Each is a Connection object
+    with its own queue, handlers and transaction table.  The first
+    connection is the primary connection; the poll, transact,
+    message_send and register methods of the controller operate on it.
+
     @todo Consider using SocketServer for listening socket
     @todo Test transaction code
 
     @var rcv_size The receive size to use for receive calls
-    @var max_pkts The max size of the receive queue
+    @var max_pkts The max number of queued messages of types without a
+    quota
+    @var max_pkt_ins The size of the packet-in ring of the receive queue
+    @var queue_quotas Dict from message type to the max number of queued
+    messages of that type.  Each type with a quota is kept in its own
+    ring, apart from the max_pkts limit; packet-ins have a quota of
+    max_pkt_ins.
+    @var queue_priorities Dict from message type to queue priority; see
+    QUEUE_PRIORITIES
+    @var max_connections The max number of simultaneous connections
     @var keep_alive If true, listen for echo requests and respond w/
     echo replies
     @var initial_hello If true, will send a hello message immediately
@@ -91,248 +173,233 @@ class Controller(Thread):
     @var switch If not None, do an active connection to the switch
     @var host The host to use for connect
     @var port The port to connect on 
-    @var packets_total Total number of packets received
-    @var packets_expired Number of packets popped from queue as queue full
-    @var packets_handled Number of packets handled by something
+    @var transport The transport creating the sockets; TCP to host and
+    port unless given, see the transport module
+    @var cxn The primary Connection
+    @var connections List of all connected Connection objects
+    @var eager_types Set of message types to fully decode on receipt.
+    Other messages are queued as LazyMessage objects and decoded when
+    they are needed by a transaction, handler or poll.
+    @var dispatcher If not None, the Dispatcher running message handlers
+    off the receive thread
+    @var capture If not None, the pcap_writer.ControlCapture recording
+    the messages of all connections
     @var dbg_state Debug indication of state
     """
 
-    def __init__(self, switch=None, host='127.0.0.1', port=6653, max_pkts=1024):
+    def __init__(self, switch=None, host='127.0.0.1', port=6653, max_pkts=1024,
+                 max_connections=1, dispatch_workers=0,
+                 dispatch_queue_size=DISPATCH_QUEUE_SIZE, transport=None,
+                 max_pkt_ins=MAX_PKT_INS):
         Thread.__init__(self)
         # Socket related
         self.rcv_size = RCV_SIZE_DEFAULT
         self.listen_socket = None
-        self.switch_socket = None
-        self.switch_addr = None
         self.connect_cv = Condition()
         self.message_cv = Condition()
-        self.tx_lock = Lock()
 
         # Used to wake up the event loop from another thread
         self.waker = ofutils.EventDescriptor()
 
+        # Sockets are registered with the reactor when created and
+        # unregistered before being closed
+        self.reactor = reactor.DefaultReactor()
+        self.reactor.register(self.waker)
+
         # Counters
         self.socket_errors = 0
-        self.parse_errors = 0
-        self.packets_total = 0
-        self.packets_expired = 0
-        self.packets_handled = 0
-        self.poll_discards = 0
 
         # State
-        self.sync = Lock()
-        self.handlers = {}
         self.keep_alive = False
         self.active = True
         self.initial_hello = True
-
-        # OpenFlow message/packet queue
-        # Protected by the packets_cv lock / condition variable
-        self.packets = []
-        self.packets_cv = Condition()
-        self.packet_in_count = 0
+        self.eager_types = set()
 
         # Settings
         self.max_pkts = max_pkts
+        self.max_pkt_ins = max_pkt_ins
+        self.queue_quotas = {OFPT_PACKET_IN: max_pkt_ins}
+        self.queue_priorities = dict(QUEUE_PRIORITIES)
+        self.max_connections = max_connections
         self.switch = switch
-        self.passive = not self.switch
         self.host = host
         self.port = port
+        if transport is None:
+            transport = TcpTransport(host, port, switch)
+        self.transport = transport
+        self.passive = self.transport.passive
         self.dbg_state = "init"
         self.logger = logging.getLogger("controller")
         self.filter_packet_in = False # Drop "excessive" packet ins
         self.pkt_in_run = 0 # Count on run of packet ins
-        self.pkt_in_filter_limit = 50 # Count on run of packet ins
+        self.pkt_in_filter_limit = PKT_IN_FILTER_LIMIT # Burst of packet ins per connection/port/reason
+        self.pkt_in_filter_rate = PKT_IN_FILTER_RATE # Packet ins per second per connection/port/reason
+        self.pkt_in_sample = 0 # If set, keep every Nth packet in over limit
         self.pkt_in_dropped = 0 # Total dropped packet ins
+        self.pkt_in_buckets = {} # (cxn id, in_port, reason) -> [tokens, time, over]
+        self.pkt_in_expected = set() # Hashes of payloads never dropped
         self.transact_to = 15 # Transact timeout default value; add to config
 
-        # Transaction and message type waiting variables 
-        #   xid_cv: Condition variable (semaphore) for packet waiters
-        #   xid: Transaction ID being waited on
-        #   xid_response: Transaction response message
-        self.xid_cv = Condition()
-        self.xid = None
-        self.xid_response = None
+        # Control channel pcap capture
+        self.capture = None
+
+        # Handlers run on the receive thread unless workers are configured
+        self.dispatcher = None
+        if dispatch_workers > 0:
+            self.dispatcher = Dispatcher(dispatch_workers, dispatch_queue_size)
 
-        self.buffered_input = ""
+        # Connections
+        #   cxn: The primary connection; reused when the switch reconnects
+        #   connections: All connected connections, protected by connect_cv
+        #   cxn_ids: Source of Connection.id values
+        self.cxn_ids = itertools.count()
+        self.cxn = Connection(self)
+        self.connections = []
 
         # Create listen socket
         if self.passive:
-            self.logger.info("Create/listen at " + self.host + ":" +
-                             str(self.port))
-            ai = socket.getaddrinfo(self.host, self.port, socket.AF_UNSPEC,
-                                    socket.SOCK_STREAM, 0, socket.AI_PASSIVE)
-            # Use first returned addrinfo
-            (family, socktype, proto, name, sockaddr) = ai[0]
-            self.listen_socket = socket.socket(family, socktype)
-            self.listen_socket.setsockopt(socket.SOL_SOCKET,
-                                          socket.SO_REUSEADDR, 1)
-            self.listen_socket.bind(sockaddr)
-            self.listen_socket.listen(LISTEN_QUEUE_SIZE)
-
-    def filter_packet(self, rawmsg, hdr):
-        """
-        Check if packet should be filtered
-
-        Currently filters packet in messages
-        @return Boolean, True if packet should be dropped
-        """
-        # XXX didn't actually check for packet-in...
-        return False
-        # Add check for packet in and rate limit
-        if self.filter_packet_in:
-            # If we were dropping packets, report number dropped
-            # TODO dont drop expected packet ins
-            if self.pkt_in_run > self.pkt_in_filter_limit:
-                self.logger.debug("Dropped %d packet ins (%d total)"
-                            % ((self.pkt_in_run - 
-                                self.pkt_in_filter_limit),
-                                self.pkt_in_dropped))
-            self.pkt_in_run = 0
+            self.logger.info("Create/listen at " + str(self.transport))
+            self.listen_socket = self.transport.listen(
+                max(LISTEN_QUEUE_SIZE, max_connections))
+            self.reactor.register(self.listen_socket)
 
-        return False
+    # The attributes below belong to the primary connection
 
-    def _pkt_handle(self, pkt):
-        """
-        Check for all packet handling conditions
+    @property
+    def switch_socket(self):
+        return self.cxn.socket
 
-        Parse and verify message 
-        Check if XID matches something waiting
-        Check if message is being expected for a poll operation
-        Check if keep alive is on and message is an echo request
-        Check if any registered handler wants the packet
-        Enqueue if none of those conditions is met
+    @property
+    def switch_addr(self):
+        return self.cxn.addr
 
-        an echo request in case keep_alive is true, followed by
-        registered message handlers.
-        @param pkt The raw packet (string) which may contain multiple OF msgs
-        """
+    @property
+    def tx_lock(self):
+        return self.cxn.tx_lock
 
-        # snag any left over data from last read()
-        pkt = self.buffered_input + pkt
-        self.buffered_input = ""
+    @property
+    def sync(self):
+        return self.cxn.sync
 
-        # Process each of the OF msgs inside the pkt
-        offset = 0
-        while offset < len(pkt):
-            if offset + 8 > len(pkt):
-                break
+    @property
+    def handlers(self):
+        return self.cxn.handlers
 
-            # Parse the header to get type
-            hdr_version, hdr_type, hdr_length, hdr_xid = cfg_ofp.message.parse_header(pkt[offset:])
+    @property
+    def packets(self):
+        return self.cxn.packets
 
-            # Use loxi to resolve to ofp of matching version
-            ofp = loxi.protocol(hdr_version)
+    @property
+    def packets_cv(self):
+        return self.cxn.packets_cv
 
-            # Extract the raw message bytes
-            if (offset + hdr_length) > len(pkt):
-                break
-            rawmsg = pkt[offset : offset + hdr_length]
-            offset += hdr_length
+    @property
+    def transactions(self):
+        return self.cxn.transactions
 
-            #if self.filter_packet(rawmsg, hdr):
-            #    continue
+    @property
+    def packet_in_count(self):
+        return self.cxn.packet_in_count
 
-            msg = ofp.message.parse_message(rawmsg)
-            if not msg:
-                self.parse_errors += 1
-                self.logger.warn("Could not parse message")
-                continue
+    @property
+    def packets_total(self):
+        return self.cxn.packets_total
 
-            self.logger.debug("Msg in: version %d class %s len %d xid %d",
-                              hdr_version, type(msg).__name__, hdr_length, hdr_xid)
+    @property
+    def packets_expired(self):
+        return self.cxn.packets_expired
 
-            with self.sync:
-                # Check if transaction is waiting
-                with self.xid_cv:
-                    if self.xid and hdr_xid == self.xid:
-                        self.logger.debug("Matched expected XID " + str(hdr_xid))
-                        self.xid_response = (msg, rawmsg)
-                        self.xid = None
-                        self.xid_cv.notify()
-                        continue
+    @property
+    def packets_handled(self):
+        return self.cxn.packets_handled
 
-                # Check if keep alive is set; if so, respond to echo requests
-                if self.keep_alive:
-                    if hdr_type == ofp.OFPT_ECHO_REQUEST:
-                        self.logger.debug("Responding to echo request")
-                        rep = ofp.message.echo_reply()
-                        rep.xid = hdr_xid
-                        # Ignoring additional data
-                        self.message_send(rep)
-                        continue
+    @property
+    def poll_discards(self):
+        return self.cxn.poll_discards
 
-                # Generalize to counters for all packet types?
-                if msg.type == ofp.OFPT_PACKET_IN:
-                    self.packet_in_count += 1
+    @property
+    def parse_errors(self):
+        return self.cxn.parse_errors
 
-                # Log error messages
-                if isinstance(msg, ofp.message.error_msg):
-                    #pylint: disable=E1103
-                    if msg.err_type in ofp.ofp_error_type_map:
-                        type_str = ofp.ofp_error_type_map[msg.err_type]
-                        if msg.err_type == ofp.OFPET_HELLO_FAILED:
-                            code_map = ofp.ofp_hello_failed_code_map
-                        elif msg.err_type == ofp.OFPET_BAD_REQUEST:
-                            code_map = ofp.ofp_bad_request_code_map
-                        elif msg.err_type == ofp.OFPET_BAD_ACTION:
-                            code_map = ofp.ofp_bad_action_code_map
-                        elif msg.err_type == ofp.OFPET_FLOW_MOD_FAILED:
-                            code_map = ofp.ofp_flow_mod_failed_code_map
-                        elif msg.err_type == ofp.OFPET_PORT_MOD_FAILED:
-                            code_map = ofp.ofp_port_mod_failed_code_map
-                        elif msg.err_type == ofp.OFPET_QUEUE_OP_FAILED:
-                            code_map = ofp.ofp_queue_op_failed_code_map
-                        else:
-                            code_map = None
-
-                        if code_map and msg.code in code_map:
-                            code_str = code_map[msg.code]
-                        else:
-                            code_str = "unknown"
-                    else:
-                        type_str = "unknown"
-                        code_str = "unknown"
-                    self.logger.warn("Received error message: xid=%d type=%s (%d) code=%s (%d)",
-                                     hdr_xid, type_str, msg.err_type, code_str, msg.code if code_str != "unknown" else -1)
-                    if msg.version >= 4 and isinstance(msg, ofp.message.bsn_error):
-                        self.logger.warn("BSN error, msg '%s'", msg.err_msg)
-
-                # Now check for message handlers; preference is given to
-                # handlers for a specific packet
-                handled = False
-                if hdr_type in self.handlers.keys():
-                    handled = self.handlers[hdr_type](self, msg, rawmsg)
-                if not handled and ("all" in self.handlers.keys()):
-                    handled = self.handlers["all"](self, msg, rawmsg)
-
-                if not handled: # Not handled, enqueue
-                    with self.packets_cv:
-                        if len(self.packets) >= self.max_pkts:
-                            self.packets.pop(0)
-                            self.packets_expired += 1
-                        self.packets.append((msg, rawmsg))
-                        self.packets_cv.notify_all()
-                    self.packets_total += 1
-                else:
-                    self.packets_handled += 1
-                    self.logger.debug("Message handled by callback")
+    def filter_packet(self, rawmsg, version, cxn_id=0):
+        """
+        Check if a packet in should be dropped
+
+        Called by the connections for each packet in while
+        filter_packet_in is set.  Packet ins whose payload was registered
+        with pkt_in_expect are always kept.  Others are rate limited with
+        a token bucket per (connection, in_port, reason) holding up to
+        pkt_in_filter_limit tokens and refilled at pkt_in_filter_rate
+        tokens per second.  If pkt_in_sample is N > 0, every Nth packet
+        in over the limit is kept as well.
+
+        @param rawmsg The packed packet in message
+        @param version The OpenFlow version of the message
+        @param cxn_id The id of the connection the message came from
+        @return Boolean, True if packet should be dropped
+        """
+        try:
+            in_port, reason, data = packet_in_fields(rawmsg, version)
+        except struct.error:
+            return False
+
+        if self.pkt_in_expected:
+            if hash(data[:PKT_IN_EXPECT_LEN]) in self.pkt_in_expected:
+                return False
+
+        now = time.time()
+        key = (cxn_id, in_port, reason)
+        bucket = self.pkt_in_buckets.get(key)
+        if bucket is None:
+            bucket = [self.pkt_in_filter_limit, now, 0]
+            self.pkt_in_buckets[key] = bucket
+        tokens = min(self.pkt_in_filter_limit,
+                     bucket[0] + (now - bucket[1]) * self.pkt_in_filter_rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            keep = True
+        else:
+            bucket[0] = tokens
+            bucket[2] += 1
+            keep = self.pkt_in_sample and bucket[2] % self.pkt_in_sample == 0
+
+        if not keep:
+            self.pkt_in_run += 1
+            self.pkt_in_dropped += 1
+            return True
+
+        # If we were dropping packets, report number dropped
+        if self.pkt_in_run:
+            self.logger.debug("Dropped %d packet ins (%d total)"
+                              % (self.pkt_in_run, self.pkt_in_dropped))
+            self.pkt_in_run = 0
+        return False
+
+    def pkt_in_expect(self, payload):
+        """
+        Never drop packet ins carrying this payload
+
+        @param payload The packet data as sent on the dataplane
+        """
+        self.pkt_in_expected.add(hash(str(payload)[:PKT_IN_EXPECT_LEN]))
 
-        # end of 'while offset < len(pkt)'
-        #   note that if offset = len(pkt), this is
-        #   appends a harmless empty string
-        self.buffered_input += pkt[offset:]
+    def pkt_in_expect_clear(self):
+        """
+        Forget the payloads registered with pkt_in_expect
+        """
+        self.pkt_in_expected.clear()
 
     def _socket_ready_handle(self, s):
         """
         Handle an input-ready socket
 
-        @param s The socket object that is ready
+        @param s The socket or Connection object that is ready
         @returns 0 on success, -1 on error
         """
 
         if self.passive and s and s == self.listen_socket:
-            if self.switch_socket:
+            if len(self.connections) >= self.max_connections:
                 self.logger.warning("Ignoring incoming connection; already connected to switch")
                 (sock, addr) = self.listen_socket.accept()
                 sock.close()
@@ -343,41 +410,18 @@ class Controller(Thread):
             except:
                 self.logger.warning("Error on listen socket accept")
                 return -1
-            self.logger.info(self.host+":"+str(self.port)+": Incoming connection from "+str(addr))
-
-            with self.connect_cv:
-                (self.switch_socket, self.switch_addr) = (sock, addr)
-                self.switch_socket.setsockopt(socket.IPPROTO_TCP,
-                                              socket.TCP_NODELAY, True)
-                if self.initial_hello:
-                    self.message_send(cfg_ofp.message.hello())
-                self.connect_cv.notify() # Notify anyone waiting
-
-            # Prevent further connections
-            self.listen_socket.close()
-            self.listen_socket = None
-        elif s and s == self.switch_socket:
-            for idx in range(3): # debug: try a couple of times
-                try:
-                    pkt = self.switch_socket.recv(self.rcv_size)
-                except:
-                    self.logger.warning("Error on switch read")
-                    return -1
-      
-                if not self.active:
-                    return 0
-      
-                if len(pkt) == 0:
-                    self.logger.warning("Zero-length switch read, %d" % idx)
-                else:
-                    break
-
-            if len(pkt) == 0: # Still no packet
-                self.logger.warning("Zero-length switch read; closing cxn")
-                self.logger.info(str(self))
-                return -1
-
-            self._pkt_handle(pkt)
+            self.logger.info(str(self.transport)+": Incoming connection from "+str(addr))
+
+            self.transport.setup(sock)
+            self.connection_add(sock, addr)
+
+            if self.max_connections == 1:
+                # Prevent further connections
+                self.reactor.unregister(self.listen_socket)
+                self.listen_socket.close()
+                self.listen_socket = None
+        elif s and s in self.connections:
+            return s.input_ready()
         elif s and s == self.waker:
             self.waker.wait()
         else:
@@ -386,23 +430,73 @@ class Controller(Thread):
 
         return 0
 
+    def connection_add(self, sock, addr):
+        """
+        Start handling a newly connected socket
+
+        The primary connection is used if it is not connected, otherwise
+        a new Connection is created.
+
+        @param sock The connected socket
+        @param addr The address of the switch
+        @returns The Connection object
+        """
+        with self.connect_cv:
+            if self.cxn.socket is None:
+                cxn = self.cxn
+            else:
+                cxn = Connection(self)
+            cxn.attach(sock, addr)
+            self.connections.append(cxn)
+            self.reactor.register(cxn)
+            if self.initial_hello:
+                cxn.message_send(cfg_ofp.message.hello())
+            self.connect_cv.notify_all() # Notify anyone waiting
+        return cxn
+
+    def connection_remove(self, cxn):
+        """
+        Close a connection and drop its queued messages
+
+        @param cxn The Connection object
+        """
+        with self.connect_cv:
+            if cxn not in self.connections:
+                return
+            self.connections.remove(cxn)
+            self.reactor.unregister(cxn)
+            cxn.close()
+            self.connect_cv.notify_all()
+
+    def wait_connections(self, count, timeout=-1):
+        """
+        Wait for switches to connect
+
+        @param count The number of connections to wait for
+        @param timeout Block for up to timeout seconds. Pass -1 for the default.
+        @returns A list of at least count Connection objects, or None on
+        timeout
+        """
+        with self.connect_cv:
+            return ofutils.timed_wait(self.connect_cv,
+                lambda: list(self.connections) if len(self.connections) >= count else None,
+                timeout=timeout)
+
     def active_connect(self):
         """
-        Actively connect to a switch IP addr
+        Actively connect to a switch through the transport
+
+        @returns A pair (sock, addr), or (None, None) on failure
         """
         try:
-            self.logger.info("Trying active connection to %s" % self.switch)
-            soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            soc.connect((self.switch, self.port))
-            self.logger.info("Connected to " + self.switch + " on " +
-                         str(self.port))
-            soc.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
-            self.switch_addr = (self.switch, self.port)
-            return soc
+            self.logger.info("Trying active connection to %s" % self.transport)
+            (soc, addr) = self.transport.connect()
+            self.logger.info("Connected to " + str(self.transport))
+            return (soc, addr)
         except (StandardError, socket.error), e:
-            self.logger.error("Could not connect to %s at %d:: %s" % 
-                              (self.switch, self.port, str(e)))
-        return None
+            self.logger.error("Could not connect to %s: %s" %
+                              (self.transport, str(e)))
+        return (None, None)
 
     def wakeup(self):
         """
@@ -410,51 +504,53 @@ class Controller(Thread):
         """
         self.waker.notify()
 
-    def sockets(self):
-        """
-        Return list of sockets to select on.
-        """
-        socs = [self.listen_socket, self.switch_socket, self.waker]
-        return [x for x in socs if x]
-
     def run(self):
         """
         Activity function for class
 
-        Assumes connection to switch already exists.  Listens on
-        switch_socket for messages until an error (or zero len pkt)
-        occurs.
+        Listens on the sockets of all connections for messages.  A
+        connection is closed when an error (or zero len pkt) occurs on
+        it.
 
         When there is a message on the socket, check for handlers; queue the
         packet if no one handles the packet.
-
-        See note for controller describing the limitation of a single
-        connection for now.
         """
 
         self.dbg_state = "running"
+        if self.dispatcher:
+            self.dispatcher.start()
 
         while self.active:
             try:
-                sel_in, sel_out, sel_err = \
-                    select.select(self.sockets(), [], self.sockets(), 1)
+                sel_in, sel_err = self.reactor.poll()
             except:
                 print sys.exc_info()
                 self.logger.error("Select error, disconnecting")
                 self.disconnect()
+                sel_in, sel_err = [], []
 
             for s in sel_err:
                 self.logger.error("Got socket error on: " + str(s) + ", disconnecting")
-                self.disconnect()
+                if s in self.connections:
+                    self.connection_remove(s)
+                else:
+                    self.disconnect()
 
             for s in sel_in:
                 if self._socket_ready_handle(s) == -1:
-                    self.disconnect()
+                    if s in self.connections:
+                        self.connection_remove(s)
+                    else:
+                        self.disconnect()
 
         # End of main loop
         self.dbg_state = "closing"
         self.logger.info("Exiting controller thread")
         self.shutdown()
+        self.reactor.close()
+        if self.dispatcher:
+            self.dispatcher.stop()
+        self.stop_capture()
 
     def connect(self, timeout=-1):
         """
@@ -465,21 +561,16 @@ class Controller(Thread):
         """
 
         if not self.passive:  # Do active connection now
-            self.logger.info("Attempting to connect to %s on port %s" %
-                             (self.switch, str(self.port)))
-            soc = self.active_connect()
+            self.logger.info("Attempting to connect to %s" % self.transport)
+            (soc, addr) = self.active_connect()
             if soc:
-                self.logger.info("Connected to %s", self.switch)
+                self.logger.info("Connected to %s", self.transport)
                 self.dbg_state = "running"
-                self.switch_socket = soc
+                self.connection_add(soc, addr)
                 self.wakeup()
-                with self.connect_cv:
-                    if self.initial_hello:
-                        self.message_send(cfg_ofp.message.hello())
-                    self.connect_cv.notify() # Notify anyone waiting
             else:
                 self.logger.error("Could not actively connect to switch %s",
-                                  self.switch)
+                                  self.transport)
                 self.active = False
         else:
             with self.connect_cv:
@@ -487,19 +578,13 @@ class Controller(Thread):
                                    timeout=timeout)
 
         return self.switch_socket is not None
-        
+
     def disconnect(self, timeout=-1):
         """
-        If connected to a switch, disconnect.
+        If connected to any switches, disconnect.
         """
-        if self.switch_socket:
-            self.switch_socket.close()
-            self.switch_socket = None
-            self.switch_addr = None
-            with self.packets_cv:
-                self.packets = []
-            with self.connect_cv:
-                self.connect_cv.notifyAll()
+        for cxn in list(self.connections):
+            self.connection_remove(cxn)
 
     def wait_disconnected(self, timeout=-1):
         """
@@ -508,11 +593,11 @@ class Controller(Thread):
         """
 
         with self.connect_cv:
-            ofutils.timed_wait(self.connect_cv, 
-                               lambda: True if not self.switch_socket else None, 
+            ofutils.timed_wait(self.connect_cv,
+                               lambda: True if not self.switch_socket else None,
                                timeout=timeout)
         return self.switch_socket is None
-        
+
     def kill(self):
         """
         Force the controller thread to quit
@@ -529,21 +614,28 @@ class Controller(Thread):
         """
 
         self.active = False
-        try:
-            self.switch_socket.shutdown(socket.SHUT_RDWR)
-        except:
-            self.logger.info("Ignoring switch soc shutdown error")
-        self.switch_socket = None
+        with self.connect_cv:
+            connections = self.connections
+            self.connections = []
+        for cxn in connections:
+            try:
+                self.reactor.unregister(cxn)
+                cxn.socket.shutdown(socket.SHUT_RDWR)
+            except:
+                self.logger.info("Ignoring switch soc shutdown error")
+            cxn.socket = None
 
         try:
+            self.reactor.unregister(self.listen_socket)
             self.listen_socket.shutdown(socket.SHUT_RDWR)
         except:
             self.logger.info("Ignoring listen soc shutdown error")
         self.listen_socket = None
+        self.transport.close()
 
         # Wakeup condition variables on which controller may be wait
-        with self.xid_cv:
-            self.xid_cv.notifyAll()
+        for cxn in connections:
+            cxn.cancel_transactions()
 
         with self.connect_cv:
             self.connect_cv.notifyAll()
@@ -551,174 +643,1974 @@ class Controller(Thread):
         self.wakeup()
         self.dbg_state = "down"
 
-    def register(self, msg_type, handler):
+    def reset(self):
         """
-        Register a callback to receive a specific message type.
+        Drop per-test state so the controller can be reused by another test
 
-        Only one handler may be registered for a given message type.
+        Clears the queues, handlers and transaction tables of all
+        connections and restores the default settings.  The switch
+        connections are kept and any control capture is stopped.
 
-        WARNING:  A lock is held during the handler call back, so 
-        the handler should not make any blocking calls
+        @returns False if a connection could not be reset because its
+        socket failed; the controller should then be replaced
+        """
+        self.stop_capture()
+        self.keep_alive = False
+        self.eager_types = set()
+        self.filter_packet_in = False
+        self.pkt_in_run = 0
+        self.pkt_in_filter_limit = PKT_IN_FILTER_LIMIT
+        self.pkt_in_filter_rate = PKT_IN_FILTER_RATE
+        self.pkt_in_sample = 0
+        self.pkt_in_buckets = {}
+        self.pkt_in_expected = set()
+        # Connection queues share these dicts, so update them in place
+        self.queue_quotas.clear()
+        self.queue_quotas[OFPT_PACKET_IN] = self.max_pkt_ins
+        self.queue_priorities.clear()
+        self.queue_priorities.update(QUEUE_PRIORITIES)
+        with self.connect_cv:
+            connections = list(self.connections)
+        ok = True
+        for cxn in connections:
+            if not cxn.reset():
+                ok = False
+        return ok
 
-        @param msg_type The type of message to receive.  May be DEFAULT 
-        for all non-handled packets.  The special type, the string "all"
-        will send all packets to the handler.
-        @param handler The function to call when a message of the given 
-        type is received.
+    def register(self, msg_type, handler):
         """
-        # Should check type is valid
-        if not handler and msg_type in self.handlers.keys():
-            del self.handlers[msg_type]
-            return
-        self.handlers[msg_type] = handler
+        Register a callback on the primary connection
+
+        See Connection.register.
+        """
+        self.cxn.register(msg_type, handler)
 
     def poll(self, exp_msg=None, timeout=-1):
         """
-        Wait for the next OF message received from the switch.
+        Wait for the next OF message received on the primary connection
 
-        @param exp_msg If set, return only when this type of message 
-        is received (unless timeout occurs).
+        See Connection.poll.
+        """
+        return self.cxn.poll(exp_msg, timeout=timeout)
 
-        @param timeout Maximum number of seconds to wait for the message.
-        Pass -1 for the default timeout.
+    def transact(self, msg, timeout=-1):
+        """
+        Run a message transaction on the primary connection
 
-        @retval A pair (msg, pkt) where msg is a message object and pkt
-        the string representing the packet as received from the socket.
-        This allows additional parsing by the receiver if necessary.
+        See Connection.transact.
+        """
+        return self.cxn.transact(msg, timeout=timeout)
 
-        The data members in the message are in host endian order.
-        If an error occurs, (None, None) is returned
+    def transact_async(self, msg):
         """
+        Start a message transaction on the primary connection
 
-        if exp_msg is None:
-            self.logger.warn("DEPRECATED polling for any message class")
-            klass = None
-        elif isinstance(exp_msg, int):
-            klass = cfg_ofp.message.message.subtypes[exp_msg]
-        elif issubclass(exp_msg, loxi.OFObject):
-            klass = exp_msg
-        else:
-            raise ValueError("Unexpected exp_msg argument %r" % exp_msg)
+        See Connection.transact_async.
+        """
+        return self.cxn.transact_async(msg)
 
-        self.logger.debug("Polling for %s", klass.__name__)
+    def transaction_remove(self, trans):
+        self.cxn.transaction_remove(trans)
 
-        # Take the packet from the queue
-        def grab():
-            for i, (msg, pkt) in enumerate(self.packets):
-                if klass is None or isinstance(msg, klass):
-                    self.logger.debug("Got %s message", msg.__class__.__name__)
-                    return self.packets.pop(i)
-            # Not found
-            self.logger.debug("%s message not in queue", klass.__name__)
-            return None
+    def cancel_transactions(self):
+        self.cxn.cancel_transactions()
 
-        with self.packets_cv:
-            ret = ofutils.timed_wait(self.packets_cv, grab, timeout=timeout)
+    def event_stream(self, msg_type, filter=None, size=EVENT_STREAM_SIZE,
+                     callback=None):
+        """
+        Open an event stream on the primary connection
 
-        if ret != None:
-            (msg, pkt) = ret
-            return (msg, pkt)
-        else:
-            return (None, None)
+        See Connection.event_stream.
+        """
+        return self.cxn.event_stream(msg_type, filter, size, callback)
 
-    def transact(self, msg, timeout=-1):
+    def flow_removed_stream(self, filter=None, size=EVENT_STREAM_SIZE,
+                            callback=None):
         """
-        Run a message transaction with the switch
+        Open a stream of the flow removed messages of the primary connection
 
-        Send the message in msg and wait for a reply with a matching
-        transaction id.  Transactions have the highest priority in
-        received message handling.
+        @param filter Optional predicate on the message, such as
+        cookie_range(low, high)
+        """
+        return self.cxn.event_stream(OFPT_FLOW_REMOVED, filter, size,
+                                     callback)
 
-        @param msg The message object to send; must not be a string
-        @param timeout The timeout in seconds; if -1 use default.
+    def port_status_stream(self, filter=None, size=EVENT_STREAM_SIZE,
+                           callback=None):
         """
+        Open a stream of the port status messages of the primary connection
+        """
+        return self.cxn.event_stream(OFPT_PORT_STATUS, filter, size,
+                                     callback)
 
-        if msg.xid == None:
-            msg.xid = ofutils.gen_xid()
+    def multipart(self, msg):
+        """
+        Send a multipart request on the primary connection
 
-        self.logger.debug("Running transaction %d" % msg.xid)
+        See Connection.multipart.
+        """
+        return self.cxn.multipart(msg)
 
-        with self.xid_cv:
-            if self.xid:
-                self.logger.error("Can only run one transaction at a time")
-                return (None, None)
+    def message_send(self, msg):
+        """
+        Send the message to the switch on the primary connection
 
-            self.xid = msg.xid
-            self.xid_response = None
-            self.message_send(msg)
+        See Connection.message_send.
+        """
+        return self.cxn.message_send(msg)
 
-            self.logger.debug("Waiting for transaction %d" % msg.xid)
-            ofutils.timed_wait(self.xid_cv, lambda: self.xid_response, timeout=timeout)
+    def message_send_many(self, msgs):
+        """
+        Send several messages on the primary connection with one write
 
-            if self.xid_response:
-                (resp, pkt) = self.xid_response
-                self.xid_response = None
-            else:
-                (resp, pkt) = (None, None)
+        See Connection.message_send_many.
+        """
+        return self.cxn.message_send_many(msgs)
 
-        if resp is None:
-            self.logger.warning("No response for xid " + str(self.xid))
-        return (resp, pkt)
+    def cork(self):
+        self.cxn.cork()
 
-    def message_send(self, msg):
-        """
-        Send the message to the switch
+    def flush(self):
+        self.cxn.flush()
 
-        @param msg A string or OpenFlow message object to be forwarded to
-        the switch.
-        """
+    def uncork(self):
+        self.cxn.uncork()
 
-        if not self.switch_socket:
-            # Sending a string indicates the message is ready to go
-            raise Exception("no socket")
+    def clear_queue(self):
+        """
+        Clear the input queue of the primary connection and report the
+        number of messages that were in it
+        """
+        return self.cxn.clear_queue()
 
-        if msg.xid == None:
-            msg.xid = ofutils.gen_xid()
+    def start_capture(self, filename):
+        """
+        Start recording all sent and received messages to a pcap file
 
-        outpkt = msg.pack()
+        A capture left running, e.g. by a test whose setUp failed, is
+        stopped first.
+        """
+        if self.capture:
+            self.logger.warn("Stopping leftover control capture")
+            self.stop_capture()
+        self.capture = ControlCapture(filename)
 
-        self.logger.debug("Msg out: version %d class %s len %d xid %d",
-                          msg.version, type(msg).__name__, len(outpkt), msg.xid)
+    def stop_capture(self):
+        """
+        Stop recording and close the pcap file
+        """
+        if self.capture:
+            capture = self.capture
+            self.capture = None
+            capture.close()
 
-        with self.tx_lock:
-            if self.switch_socket.sendall(outpkt) is not None:
-                raise AssertionError("failed to send message to switch")
+    def stats_get(self):
+        """
+        Return the statistics of all connections
 
-        return 0 # for backwards compatibility
+        @returns A stats.MessageStats summing the statistics of the
+        primary connection and all connected connections
+        """
+        result = stats.MessageStats()
+        with self.connect_cv:
+            connections = list(self.connections)
+        if self.cxn not in connections:
+            connections.append(self.cxn)
+        for cxn in connections:
+            result.merge(cxn.stats)
+        return result
+
+    def stats_reset(self):
+        """
+        Clear the statistics of all connections
+        """
+        with self.connect_cv:
+            connections = list(self.connections)
+        if self.cxn not in connections:
+            connections.append(self.cxn)
+        for cxn in connections:
+            cxn.stats.reset()
 
-    def clear_queue(self):
+    def stats_dump(self, logger=None, level=logging.INFO):
         """
-        Clear the input queue and report the number of messages
-        that were in it
+        Log the statistics of all connections
+
+        @param logger The logger to use; the controller logger by default
+        @param level The logging level
         """
-        enqueued_pkt_count = len(self.packets)
-        with self.packets_cv:
-            self.packets = []
-        return enqueued_pkt_count
+        if logger is None:
+            logger = self.logger
+        if not logger.isEnabledFor(level):
+            return
+        self.stats_get().dump(logger, type_map=cfg_ofp.ofp_type_map,
+                              prefix="stats: ", level=level)
+        if self.dispatcher:
+            logger.log(level, "stats: dispatch %s", self.dispatcher)
 
     def __str__(self):
         string = "Controller:\n"
         string += "  state           " + self.dbg_state + "\n"
         string += "  switch_addr     " + str(self.switch_addr) + "\n"
+        string += "  connections     " + str(len(self.connections)) + "\n"
         string += "  pending pkts    " + str(len(self.packets)) + "\n"
         string += "  total pkts      " + str(self.packets_total) + "\n"
         string += "  expired pkts    " + str(self.packets_expired) + "\n"
         string += "  handled pkts    " + str(self.packets_handled) + "\n"
         string += "  poll discards   " + str(self.poll_discards) + "\n"
         string += "  parse errors    " + str(self.parse_errors) + "\n"
+        string += "  handler errors  " + str(self.cxn.errors) + "\n"
         string += "  sock errrors    " + str(self.socket_errors) + "\n"
         string += "  max pkts        " + str(self.max_pkts) + "\n"
+        string += "  queue quotas    " + str(self.queue_quotas) + "\n"
         string += "  target switch   " + str(self.switch) + "\n"
         string += "  host            " + str(self.host) + "\n"
         string += "  port            " + str(self.port) + "\n"
+        string += "  transport       " + str(self.transport) + "\n"
         string += "  keep_alive      " + str(self.keep_alive) + "\n"
         string += "  pkt_in_run      " + str(self.pkt_in_run) + "\n"
         string += "  pkt_in_dropped  " + str(self.pkt_in_dropped) + "\n"
+        string += "  dispatch        " + str(self.dispatcher) + "\n"
+        for msg_type, stats in self.cxn.handler_stats.items():
+            string += "  handler %-7s " % msg_type + str(stats) + "\n"
         return string
 
     def show(self):
         print str(self)
 
+class Connection(object):
+    """
+    A single OpenFlow connection to a switch
+
+    Created by the Controller when a switch connects.  Each connection
+    has its own receive buffer, message queue, handlers and transaction
+    table.  Settings such as keep_alive, max_pkts and eager_types are
+    taken from the controller.
+
+    @var controller The Controller owning this connection
+    @var id Number of this connection, unique within the controller
+    @var socket The connected socket, or None
+    @var addr The address of the switch
+    @var local_addr The local address of the socket
+    @var datapath_id The datapath id of the switch, once identify() is done
+    @var auxiliary_id The auxiliary connection id, once identify() is done
+    @var packets_total Total number of packets received
+    @var packets_expired Number of packets popped from queue as queue full
+    @var packets_handled Number of packets handled by something
+    @var errors Number of exceptions raised by handlers, event stream
+    filters and callbacks run on the receive thread
+    @var handler_stats Dict from message type (or "all") to the
+    HandlerStats of the handler registered for it
+    @var stats stats.MessageStats with per-type counters and transaction
+    latencies
+    """
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.id = next(controller.cxn_ids)
+        self.logger = controller.logger
+        self.socket = None
+        self.addr = None
+        self.local_addr = None
+        self.datapath_id = None
+        self.auxiliary_id = None
+
+        # Counters
+        self.parse_errors = 0
+        self.packets_total = 0
+        self.packets_expired = 0
+        self.packets_handled = 0
+        self.poll_discards = 0
+        self.errors = 0
+        self.stats = stats.MessageStats()
+
+        # State
+        self.sync = Lock()
+        self.handlers = {}
+        self.handler_stats = {}
+
+        # OpenFlow message/packet queue
+        # Protected by the packets_cv lock / condition variable
+        self.packets = MessageQueue(controller.queue_quotas,
+                                    controller.queue_priorities,
+                                    self._parse_error)
+        self.packets_cv = Condition()
+        self.packet_in_count = 0
+
+        # Event streams
+        #   event_streams: dict from message type to a tuple of
+        #   EventStreams; replaced rather than modified, so the receive
+        #   thread reads it without locking
+        #   event_streams_lock: Serializes changes to event_streams
+        self.event_streams = {}
+        self.event_streams_lock = Lock()
+
+        # Receive order of the messages given to handlers or the queue;
+        # written by the receive thread only
+        self.rx_seq = 0
+
+        # Dispatch worker progress
+        #   dispatch_put: Messages handed to the dispatcher; written by
+        #   the receive thread only
+        #   dispatch_done: Messages the worker has finished; written by
+        #   the worker only, under dispatch_cv
+        self.dispatch_put = 0
+        self.dispatch_done = 0
+        self.dispatch_cv = Condition()
+
+        # Outstanding transactions
+        #   transactions: dict from xid to Transaction waiting on a reply
+        #   streams: dict from xid to MultipartStream waiting on replies
+        #   transactions_lock: Protects the transactions and streams dicts
+        #   xids: Allocates xids and tracks the outstanding ones
+        self.transactions = {}
+        self.streams = {}
+        self.transactions_lock = Lock()
+        self.xids = ofutils.XidAllocator()
+
+        # Transmit state, protected by tx_lock
+        #   tx_corked: If true, sent messages are buffered until flush
+        #   tx_pending: List of packed messages waiting to be written
+        #   tx_pending_len: Total length of tx_pending
+        #   tx_pending_xids: Xids of the messages in tx_pending
+        self.tx_lock = Lock()
+        self.tx_corked = False
+        self.tx_pending = []
+        self.tx_pending_len = 0
+        self.tx_pending_xids = []
+
+        # Receive buffer, filled with recv_into
+        #   rx_buf: bytearray holding received but unprocessed data
+        #   rx_start: Offset of the first unprocessed byte
+        #   rx_end: Offset just past the last received byte
+        self.rx_buf = bytearray(2 * controller.rcv_size)
+        self.rx_view = memoryview(self.rx_buf)
+        self.rx_start = 0
+        self.rx_end = 0
+
+    def fileno(self):
+        """
+        Return an integer file descriptor that can be passed to select(2).
+        """
+        return self.socket.fileno()
+
+    def attach(self, sock, addr):
+        """
+        Start using a newly connected socket
+        """
+        self.socket = sock
+        self.addr = addr
+        try:
+            self.local_addr = sock.getsockname()
+        except socket.error:
+            self.local_addr = None
+        self.rx_start = self.rx_end = 0
+        self.tx_pending = []
+        self.tx_pending_len = 0
+        self.tx_pending_xids = []
+
+    def close(self):
+        """
+        Close the socket, drop queued messages and cancel transactions
+        """
+        if self.socket:
+            self.socket.close()
+        self.socket = None
+        self.addr = None
+        self.datapath_id = None
+        self.auxiliary_id = None
+        self.rx_start = self.rx_end = 0
+        with self.packets_cv:
+            self.packets.clear()
+        self.cancel_transactions()
+
+    def reset(self):
+        """
+        Drop queued messages, handlers and outstanding transactions
+
+        Corked output is written and corking is turned off.  A barrier
+        is run first so that replies to the last test's requests have
+        arrived before the queue is cleared, and the messages still with
+        the dispatch worker are finished.  Both share one deadline of
+        RESET_BARRIER_TIMEOUT seconds.
+
+        @returns False if the barrier could not be sent
+        """
+        ok = True
+        deadline = time.time() + RESET_BARRIER_TIMEOUT
+        if self.socket:
+            try:
+                self.uncork()
+                reply, _ = self.transact(cfg_ofp.message.barrier_request(),
+                                         timeout=RESET_BARRIER_TIMEOUT)
+                if reply is None:
+                    self.logger.warning("No barrier reply resetting "
+                                        "connection %d", self.id)
+            except Exception:
+                self.logger.exception("Barrier failed resetting "
+                                      "connection %d", self.id)
+                ok = False
+        self.handlers.clear()
+        if self.controller.dispatcher:
+            if not self.dispatch_wait(
+                    timeout=max(0, deadline - time.time())):
+                self.logger.warning("Dispatch worker still busy resetting "
+                                    "connection %d", self.id)
+        self.handler_stats.clear()
+        self.stats.reset()
+        self.clear_queue()
+        self.cancel_transactions()
+        for streams in self.event_streams.values():
+            for stream in streams:
+                stream.close()
+        return ok
+
+    def identify(self, timeout=-1):
+        """
+        Learn the datapath id and auxiliary id of the connection
+
+        Runs a features_request transaction.
+
+        @param timeout The timeout in seconds; if -1 use default.
+        @returns Boolean, True if the features_reply was received
+        """
+        reply, _ = self.transact(cfg_ofp.message.features_request(),
+                                 timeout=timeout)
+        if reply is None:
+            return False
+        self.datapath_id = reply.datapath_id
+        self.auxiliary_id = getattr(reply, "auxiliary_id", 0)
+        return True
+
+    def input_ready(self):
+        """
+        Handle input on the socket
+
+        @returns 0 on success, -1 on error
+        """
+        for idx in range(3): # debug: try a couple of times
+            try:
+                count = self._recv()
+            except:
+                self.logger.warning("Error on switch read")
+                return -1
+      
+            if not self.controller.active:
+                return 0
+      
+            if count == 0:
+                self.logger.warning("Zero-length switch read, %d" % idx)
+            else:
+                break
+
+        if count == 0: # Still no packet
+            self.logger.warning("Zero-length switch read; closing cxn")
+            self.logger.info(str(self.controller))
+            return -1
+
+        self._pkt_handle()
+
+        return 0
+
+    def _recv(self):
+        """
+        Read from the switch socket into the receive buffer
+
+        Unprocessed data (at most a partial message) is first moved to the
+        front of the buffer, and the buffer is grown if needed so that
+        rcv_size bytes can always be read.
+
+        @returns The number of bytes read
+        """
+        pending = self.rx_end - self.rx_start
+        if self.rx_start > 0:
+            if pending:
+                self.rx_buf[:pending] = self.rx_view[self.rx_start:self.rx_end].tobytes()
+            self.rx_start = 0
+            self.rx_end = pending
+
+        if len(self.rx_buf) - self.rx_end < self.controller.rcv_size:
+            rx_buf = bytearray(max(2 * len(self.rx_buf), pending + self.controller.rcv_size))
+            rx_buf[:pending] = self.rx_view[:pending].tobytes()
+            self.rx_buf = rx_buf
+            self.rx_view = memoryview(rx_buf)
+
+        count = self.socket.recv_into(self.rx_view[self.rx_end:],
+                                      self.controller.rcv_size)
+        self.rx_end += count
+        return count
+
+    def _pkt_handle(self):
+        """
+        Check for all packet handling conditions
+
+        Parse and verify message 
+        Check if XID matches something waiting
+        Check if message is being expected for a poll operation
+        Check if keep alive is on and message is an echo request
+        Check if any registered handler wants the packet
+        Enqueue if none of those conditions is met
+
+        an echo request in case keep_alive is true, followed by
+        registered message handlers.
+
+        Each complete OF msg in the receive buffer is processed.  Headers
+        are parsed in place; the message bytes are copied out of the buffer
+        once, when the message is complete.  When keep_alive is true, echo
+        requests are answered from the header before any decoding or
+        locking.
+        """
+
+        # Process each of the OF msgs inside the receive buffer
+        while self.rx_end - self.rx_start >= OFP_HEADER.size:
+            offset = self.rx_start
+
+            # Parse the header to get type
+            hdr_version, hdr_type, hdr_length, hdr_xid = \
+                OFP_HEADER.unpack_from(self.rx_buf, offset)
+
+            if hdr_length < OFP_HEADER.size:
+                self.parse_errors += 1
+                self.logger.error("Invalid message length %d; discarding input",
+                                  hdr_length)
+                self.rx_start = self.rx_end
+                break
+
+            # Extract the raw message bytes
+            if (offset + hdr_length) > self.rx_end:
+                break
+            rawmsg = self.rx_view[offset : offset + hdr_length].tobytes()
+            self.rx_start = offset + hdr_length
+            self.stats.rx(hdr_type, hdr_length)
+            capture = self.controller.capture
+            if capture:
+                capture.message(self.id, self.local_addr, self.addr,
+                                rawmsg, False)
+
+            # Answer echo requests from the header alone
+            if hdr_type == OFPT_ECHO_REQUEST and self.controller.keep_alive \
+                    and hdr_xid not in self.transactions:
+                self._echo_reply(rawmsg)
+                continue
+
+            # Use loxi to resolve to ofp of matching version
+            ofp = loxi.protocol(hdr_version)
+
+            if hdr_type == ofp.OFPT_PACKET_IN and \
+                    self.controller.filter_packet_in and \
+                    self.controller.filter_packet(rawmsg, hdr_version,
+                                                  self.id):
+                continue
+
+            # Only the header is decoded unless the message is needed below
+            msg = LazyMessage(rawmsg, hdr_version, hdr_type, hdr_xid)
+
+            self.logger.debug("Msg in: version %d class %s len %d xid %d",
+                              hdr_version, msg.class_name(), hdr_length, hdr_xid)
+
+            if hdr_type in self.controller.eager_types:
+                msg = self._decode(msg)
+                if msg is None:
+                    continue
+
+            with self.sync:
+                # Check if transaction is waiting
+                with self.transactions_lock:
+                    trans = self.transactions.pop(hdr_xid, None)
+                    stream = trans is None and self.streams.get(hdr_xid)
+                if stream:
+                    self.logger.debug("Matched multipart XID " + str(hdr_xid))
+                    if not stream.deliver(self._decode(msg), rawmsg):
+                        self._rtt_record(stream.msg_type, hdr_xid)
+                        self.stream_remove(stream)
+                    continue
+                if trans:
+                    self.logger.debug("Matched expected XID " + str(hdr_xid))
+                    self._rtt_record(trans.msg_type, hdr_xid)
+                    trans.complete(self._decode(msg), rawmsg)
+                    continue
+
+                if hdr_xid and self.xids.stale(hdr_xid):
+                    self.stats.stale_reply()
+                    self.logger.debug("Late reply for XID " + str(hdr_xid))
+
+                # Generalize to counters for all packet types?
+                if hdr_type == ofp.OFPT_PACKET_IN:
+                    self.packet_in_count += 1
+
+                # Count and log error messages
+                if hdr_type == ofp.OFPT_ERROR:
+                    if not self._error_record(msg, rawmsg):
+                        continue
+
+                # Event streams take their messages before handlers
+                streams = self.event_streams.get(hdr_type)
+                if streams and self._event_deliver(streams, msg, rawmsg):
+                    continue
+
+                # Now check for message handlers.  Messages a dispatch
+                # worker leaves unhandled are queued with their receive
+                # sequence number, so the poll queue stays in wire order.
+                seq = self.rx_seq
+                self.rx_seq += 1
+                handled = hdr_type in self.handlers or "all" in self.handlers
+                dispatcher = self.controller.dispatcher
+                if not handled:
+                    self._enqueue(msg, rawmsg, seq)
+                elif not dispatcher:
+                    try:
+                        self._dispatch(msg, rawmsg, seq)
+                    except:
+                        self.errors += 1
+                        self.logger.exception("Message handler failed")
+                elif dispatcher.put(self, msg, rawmsg, seq,
+                        self.controller.queue_priorities.get(hdr_type) ==
+                        QUEUE_PRIORITY_DATA):
+                    self.dispatch_put += 1
+                else:
+                    self.stats.drop(hdr_type)
+                    self.logger.debug("Dispatch queue full, dropped "
+                                      "message type %d", hdr_type)
+
+        # Any partial message is left in the buffer for the next read
+
+    def _event_deliver(self, streams, msg, rawmsg):
+        """
+        Give a message to the event streams whose filter accepts it
+
+        @returns True if a stream took the message
+        """
+        msg = self._decode(msg)
+        if msg is None:
+            return True
+        taken = False
+        for stream in streams:
+            try:
+                if stream.matches(msg):
+                    taken = True
+                    stream.deliver(msg, rawmsg)
+            except:
+                self.errors += 1
+                self.logger.exception("Event stream filter or callback failed")
+        return taken
+
+    def _rtt_record(self, msg_type, xid):
+        sent = self.xids.release(xid)
+        if sent is not None:
+            self.stats.rtt_record(msg_type, time.time() - sent)
+
+    def _error_record(self, msg, rawmsg):
+        """
+        Count a received error message and log it
+
+        Only the first ERROR_LOG_LIMIT errors of each (type, code) are
+        logged; the rest are only counted in stats.
+
+        @returns False if the message is too short to be an error message
+        """
+        if len(rawmsg) < OFP_HEADER.size + ERROR_HEADER.size:
+            self.parse_errors += 1
+            self.logger.warn("Could not parse message")
+            return False
+        err_type, code = ERROR_HEADER.unpack_from(rawmsg, OFP_HEADER.size)
+        count = self.stats.error(err_type, code)
+        if count > ERROR_LOG_LIMIT:
+            return True
+
+        type_str, code_str = error_names(msg.version, err_type, code)
+        self.logger.warn("Received error message: xid=%d type=%s (%d) code=%s (%d)",
+                         msg.xid, type_str, err_type, code_str, code)
+        if count == ERROR_LOG_LIMIT:
+            self.logger.warn("Further %s/%s errors are only counted",
+                             type_str, code_str)
+        if msg.version >= 4 and err_type == OFPET_EXPERIMENTER:
+            err = self._decode(msg)
+            if isinstance(err, loxi.protocol(msg.version).message.bsn_error):
+                self.logger.warn("BSN error, msg '%s'", err.err_msg)
+        return True
+
+    def _echo_reply(self, rawmsg):
+        """
+        Answer an echo request without decoding it
+
+        The reply is the request with the type byte rewritten, so it
+        carries the same xid and data.  It is written immediately, even
+        if output is corked; corked messages stay buffered.
+        """
+        self.logger.debug("Responding to echo request")
+        reply = rawmsg[0] + chr(OFPT_ECHO_REPLY) + rawmsg[2:]
+        self.stats.tx(OFPT_ECHO_REPLY, len(reply))
+        capture = self.controller.capture
+        if capture:
+            capture.message(self.id, self.local_addr, self.addr, reply, True)
+        with self.tx_lock:
+            if not self.socket:
+                return
+            if self.socket.sendall(reply) is not None:
+                raise AssertionError("failed to send message to switch")
+
+    def _dispatch(self, msg, rawmsg, seq=None):
+        """
+        Pass a message to the registered handlers, enqueue it if unhandled
+
+        Preference is given to the handler for the specific message type.
+        Called on the receive thread, or on a dispatch worker.
+
+        @param seq The receive sequence number of the message
+        """
+        if msg.type in self.handlers or "all" in self.handlers:
+            msg = self._decode(msg)
+            if msg is None:
+                return
+        handled = False
+        handler = self.handlers.get(msg.type)
+        if handler:
+            handled = self._handler_call(msg.type, handler, msg, rawmsg)
+        if not handled:
+            handler = self.handlers.get("all")
+            if handler:
+                handled = self._handler_call("all", handler, msg, rawmsg)
+
+        if not handled: # Not handled, enqueue
+            self._enqueue(msg, rawmsg, seq)
+        else:
+            self.packets_handled += 1
+            self.logger.debug("Message handled by callback")
+
+    def _dispatch_finished(self):
+        """
+        Count a message finished by the dispatch worker
+        """
+        with self.dispatch_cv:
+            self.dispatch_done += 1
+            self.dispatch_cv.notify_all()
+
+    def dispatch_wait(self, timeout=-1):
+        """
+        Wait for the dispatch worker to finish the queued messages of
+        this connection
+
+        @param timeout The timeout in seconds; if -1 use default.
+        @returns Boolean, True if no messages are left with the worker
+        """
+        with self.dispatch_cv:
+            return ofutils.timed_wait(self.dispatch_cv,
+                lambda: self.dispatch_done == self.dispatch_put or None,
+                timeout=timeout) is not None
+
+    def _handler_call(self, msg_type, handler, msg, rawmsg):
+        """
+        Call a handler and record its run time in handler_stats
+        """
+        start = time.time()
+        try:
+            return handler(self, msg, rawmsg)
+        finally:
+            stats = self.handler_stats.get(msg_type)
+            if stats is None or stats.handler is not handler:
+                stats = self.handler_stats[msg_type] = HandlerStats(handler)
+            stats.record(time.time() - start)
+
+    def _enqueue(self, msg, rawmsg, seq=None):
+        """
+        Add a message to the queue read by poll
+
+        @param seq The receive sequence number of the message, or None
+        to add it after all queued messages
+        """
+        with self.packets_cv:
+            dropped = self.packets.append(msg, rawmsg,
+                                          self.controller.max_pkts, seq)
+            if dropped is not None:
+                self.packets_expired += 1
+                self.stats.drop(dropped)
+            self.stats.queue_len(len(self.packets))
+            self.packets_cv.notify_all()
+        self.packets_total += 1
+
+    def _decode(self, msg):
+        """
+        Fully decode a received message
+
+        @param msg A LazyMessage or an already decoded message
+        @returns The message object, or None if it could not be parsed
+        """
+        ret = unwrap(msg)
+        if ret is None:
+            self._parse_error()
+        return ret
+
+    def _parse_error(self):
+        """
+        Count a received message that could not be parsed
+        """
+        self.parse_errors += 1
+        self.logger.warn("Could not parse message")
+
+    def register(self, msg_type, handler):
+        """
+        Register a callback to receive a specific message type.
+
+        Only one handler may be registered for a given message type.
+
+        WARNING:  Unless the controller has dispatch workers, the handler
+        is called on the receive thread with a lock held, so the handler
+        should not make any blocking calls.  With dispatch workers the
+        handlers of one connection are called in order on one worker
+        thread, and may use transact; packet-ins arriving while the
+        worker's queue is full are dropped.  Messages a handler declines
+        are placed in the poll queue in the order they were received.
+
+        @param msg_type The type of message to receive.  May be DEFAULT 
+        for all non-handled packets.  The special type, the string "all"
+        will send all packets to the handler.
+        @param handler The function to call when a message of the given 
+        type is received.
+        """
+        # Should check type is valid
+        if not handler and msg_type in self.handlers.keys():
+            del self.handlers[msg_type]
+            return
+        self.handlers[msg_type] = handler
+
+    def poll(self, exp_msg=None, timeout=-1):
+        """
+        Wait for the next OF message received from the switch.
+
+        @param exp_msg If set, return only when this type of message 
+        is received (unless timeout occurs).
+
+        @param timeout Maximum number of seconds to wait for the message.
+        Pass -1 for the default timeout.
+
+        @retval A pair (msg, pkt) where msg is a message object and pkt
+        the string representing the packet as received from the socket.
+        This allows additional parsing by the receiver if necessary.
+
+        The data members in the message are in host endian order.
+        If an error occurs, (None, None) is returned
+        """
+
+        if exp_msg is None:
+            self.logger.warn("DEPRECATED polling for any message class")
+            klass = None
+        elif isinstance(exp_msg, int):
+            klass = cfg_ofp.message.message.subtypes[exp_msg]
+        elif issubclass(exp_msg, loxi.OFObject):
+            klass = exp_msg
+        else:
+            raise ValueError("Unexpected exp_msg argument %r" % exp_msg)
+
+        self.logger.debug("Polling for %s", klass.__name__)
+
+        # Take the packet from the queue
+        def grab():
+            ret = self.packets.grab(klass)
+            if ret:
+                self.logger.debug("Got %s message", ret[0].__class__.__name__)
+            else:
+                self.logger.debug("%s message not in queue",
+                                  klass and klass.__name__)
+            return ret
+
+        with self.packets_cv:
+            ret = ofutils.timed_wait(self.packets_cv, grab, timeout=timeout)
+
+        if ret != None:
+            (msg, pkt) = ret
+            return (msg, pkt)
+        else:
+            return (None, None)
+
+    def transact(self, msg, timeout=-1):
+        """
+        Run a message transaction with the switch
+
+        Send the message in msg and wait for a reply with a matching
+        transaction id.  Transactions have the highest priority in
+        received message handling.  Several threads may run transactions
+        concurrently; see transact_async to pipeline from one thread.
+
+        @param msg The message object to send; must not be a string
+        @param timeout The timeout in seconds; if -1 use default.
+        """
+
+        start = time.time()
+        trans = self.transact_async(msg)
+        if trans is None:
+            return (None, None)
+
+        # Don't wait on a request sitting in the corked output
+        self.flush()
+
+        self.logger.debug("Waiting for transaction %d" % msg.xid)
+        (resp, pkt) = trans.wait(timeout=timeout)
+
+        if resp is None:
+            self.logger.warning("No response for xid " + str(msg.xid))
+        else:
+            self.stats.transact_record(msg.type, time.time() - start)
+        return (resp, pkt)
+
+    def transact_async(self, msg):
+        """
+        Start a message transaction with the switch without waiting
+
+        Send the message in msg and return a Transaction that will be
+        completed by the reply with a matching transaction id.  Any
+        number of transactions may be outstanding at once, so requests
+        can be pipelined and the replies collected afterwards:
+
+            transactions = [self.controller.transact_async(m) for m in msgs]
+            replies = [t.wait() for t in transactions]
+
+        @param msg The message object to send; must not be a string
+        @returns A Transaction object, or None if a transaction with the
+        same xid is already outstanding
+        """
+
+        if msg.xid == None:
+            msg.xid = self.xids.next()
+
+        self.logger.debug("Running transaction %d" % msg.xid)
+
+        trans = Transaction(self, msg.xid, msg.type)
+        with self.transactions_lock:
+            if msg.xid in self.streams or not self.xids.reserve(msg.xid):
+                self.logger.error("Transaction %d already outstanding", msg.xid)
+                return None
+            self.transactions[msg.xid] = trans
+
+        try:
+            self.message_send(msg)
+        except:
+            self.transaction_remove(trans)
+            raise
+
+        return trans
+
+    def transaction_remove(self, trans):
+        """
+        Stop waiting for the reply to a transaction
+
+        A reply arriving later is queued like any other message.
+
+        @param trans The Transaction object returned by transact_async
+        """
+        with self.transactions_lock:
+            if self.transactions.get(trans.xid) is trans:
+                del self.transactions[trans.xid]
+                self.xids.release(trans.xid, expired=True)
+
+    def multipart(self, msg):
+        """
+        Send a multipart (stats) request and stream its replies
+
+        All reply segments with the xid of the request are collected by a
+        MultipartStream, which yields them in order as they arrive.  The
+        stream should be closed when the caller is done with it.
+
+        @param msg The request message object
+        @returns A MultipartStream, or None if the xid is already in use
+        """
+        if msg.xid == None:
+            msg.xid = self.xids.next()
+
+        stream = MultipartStream(self, msg.xid, msg.type)
+        with self.transactions_lock:
+            if msg.xid in self.transactions or msg.xid in self.streams or \
+                    not self.xids.reserve(msg.xid):
+                self.logger.error("Transaction %d already outstanding", msg.xid)
+                return None
+            self.streams[msg.xid] = stream
+
+        try:
+            self.message_send(msg)
+            self.flush()
+        except:
+            self.stream_remove(stream)
+            raise
+
+        return stream
+
+    def stream_remove(self, stream):
+        """
+        Stop collecting replies for a MultipartStream
+        """
+        with self.transactions_lock:
+            if self.streams.get(stream.xid) is stream:
+                del self.streams[stream.xid]
+                self.xids.release(stream.xid, expired=not stream.finished)
+
+    def event_stream(self, msg_type, filter=None, size=EVENT_STREAM_SIZE,
+                     callback=None):
+        """
+        Open a stream of asynchronous messages of one type
+
+        Received messages of msg_type accepted by the filter go to the
+        stream instead of the handlers and the message queue.  A message
+        accepted by no stream is handled as usual.  The stream should be
+        closed when the test is done with it; Controller.reset closes
+        all streams.
+
+        @param msg_type The message type number, e.g. ofp.OFPT_FLOW_REMOVED
+        @param filter Optional predicate taking the message object
+        @param size Number of events held; the oldest event is dropped
+        when the stream is full
+        @param callback Optional function called as callback(msg, pkt)
+        for each event on the receive thread instead of holding it
+        @returns An EventStream
+        """
+        stream = EventStream(self, msg_type, filter, size, callback)
+        with self.event_streams_lock:
+            streams = self.event_streams.get(msg_type, ())
+            self.event_streams = dict(self.event_streams)
+            self.event_streams[msg_type] = streams + (stream,)
+        return stream
+
+    def event_stream_remove(self, stream):
+        """
+        Stop delivering messages to an EventStream
+        """
+        with self.event_streams_lock:
+            streams = self.event_streams.get(stream.msg_type, ())
+            if stream not in streams:
+                return
+            streams = tuple(x for x in streams if x is not stream)
+            self.event_streams = dict(self.event_streams)
+            if streams:
+                self.event_streams[stream.msg_type] = streams
+            else:
+                del self.event_streams[stream.msg_type]
+
+    def cancel_transactions(self):
+        """
+        Abandon all outstanding transactions and streams, waking up their
+        waiters
+        """
+        with self.transactions_lock:
+            transactions = self.transactions.values()
+            self.transactions = {}
+            streams = self.streams.values()
+            self.streams = {}
+            self.xids.clear()
+        for trans in transactions:
+            trans.cancel()
+        for stream in streams:
+            stream.cancel()
+
+    def message_send(self, msg):
+        """
+        Send the message to the switch
+
+        @param msg A string or OpenFlow message object to be forwarded to
+        the switch.
+        """
+
+        if not self.socket:
+            # Sending a string indicates the message is ready to go
+            raise Exception("no socket")
+
+        outpkt = self._pack(msg)
+
+        with self.tx_lock:
+            self._write(outpkt, [msg.xid])
+
+        return 0 # for backwards compatibility
+
+    def message_send_many(self, msgs):
+        """
+        Send several messages to the switch with a single write
+
+        The messages are packed into one buffer, so a burst of messages
+        costs one system call and one acquisition of the transmit lock.
+
+        @param msgs A list of OpenFlow message objects
+        @returns A list of the xids of the messages, in order
+        """
+
+        if not self.socket:
+            raise Exception("no socket")
+
+        outpkts = [self._pack(msg) for msg in msgs]
+
+        with self.tx_lock:
+            self._write(''.join(outpkts), [msg.xid for msg in msgs])
+
+        return [msg.xid for msg in msgs]
+
+    def cork(self):
+        """
+        Buffer sent messages instead of writing them immediately
+
+        Output is written by flush(), by uncork(), whenever TX_FLUSH_SIZE
+        bytes are pending, and before transact waits for its reply.
+        """
+        with self.tx_lock:
+            self.tx_corked = True
+
+    def flush(self):
+        """
+        Write any messages buffered while corked
+        """
+        with self.tx_lock:
+            self._flush()
+
+    def uncork(self):
+        """
+        Write any buffered messages and stop buffering
+        """
+        with self.tx_lock:
+            self.tx_corked = False
+            self._flush()
+
+    def _pack(self, msg):
+        if msg.xid == None:
+            msg.xid = self.xids.next()
+
+        outpkt = msg.pack()
+        self.stats.tx(msg.type, len(outpkt))
+        capture = self.controller.capture
+        if capture:
+            capture.message(self.id, self.local_addr, self.addr, outpkt, True)
+
+        self.logger.debug("Msg out: version %d class %s len %d xid %d",
+                          msg.version, type(msg).__name__, len(outpkt), msg.xid)
+        return outpkt
+
+    def _write(self, outpkt, xids):
+        """
+        Write or buffer packed output; tx_lock must be held
+
+        @param xids The xids of the messages in outpkt; the send time of
+        those that are outstanding is recorded when they are written
+        """
+        if self.tx_corked:
+            self.tx_pending.append(outpkt)
+            self.tx_pending_len += len(outpkt)
+            self.tx_pending_xids.extend(xids)
+            if self.tx_pending_len >= TX_FLUSH_SIZE:
+                self._flush()
+            return
+        for xid in xids:
+            self.xids.sent(xid)
+        if self.socket.sendall(outpkt) is not None:
+            raise AssertionError("failed to send message to switch")
+
+    def _flush(self):
+        """
+        Write buffered output; tx_lock must be held
+        """
+        if not self.tx_pending:
+            return
+        outpkt = ''.join(self.tx_pending)
+        xids = self.tx_pending_xids
+        self.tx_pending = []
+        self.tx_pending_len = 0
+        self.tx_pending_xids = []
+        if not self.socket:
+            raise Exception("no socket")
+        for xid in xids:
+            self.xids.sent(xid)
+        if self.socket.sendall(outpkt) is not None:
+            raise AssertionError("failed to send message to switch")
+
+    def clear_queue(self):
+        """
+        Clear the input queue and report the number of messages
+        that were in it
+        """
+        with self.packets_cv:
+            enqueued_pkt_count = len(self.packets)
+            self.packets.clear()
+        return enqueued_pkt_count
+
+class LazyMessage(object):
+    """
+    A received message of which only the header has been decoded
+
+    The full loxi unpack is deferred until decode() is called or an
+    attribute other than the header fields is accessed.
+
+    @var version The OpenFlow version from the header
+    @var type The message type from the header
+    @var xid The transaction id from the header
+    @var pkt The raw message
+    """
+
+    __slots__ = ['version', 'type', 'xid', 'pkt', 'msg', 'decoded']
+
+    def __init__(self, pkt, version, type, xid):
+        self.pkt = pkt
+        self.version = version
+        self.type = type
+        self.xid = xid
+        self.msg = None
+        self.decoded = False
+
+    def __getattr__(self, name):
+        return getattr(self.decode(), name)
+
+    def decode(self):
+        """
+        @returns The parsed message object, or None if it could not be
+        parsed
+        """
+        if not self.decoded:
+            # Other threads may read the message; only mark it decoded
+            # once msg holds the result
+            try:
+                msg = loxi.protocol(self.version).message.parse_message(self.pkt)
+            except loxi.ProtocolError:
+                msg = None
+            self.msg = msg
+            self.decoded = True
+        return self.msg
+
+    def base_class(self):
+        """
+        @returns The loxi class for this message type, without looking at
+        any subtype fields (e.g. error_msg or stats_reply), or None
+        """
+        return loxi.protocol(self.version).message.message.subtypes.get(self.type)
+
+    def class_name(self):
+        if self.decoded:
+            return type(self.msg).__name__
+        return getattr(self.base_class(), '__name__', 'unknown')
+
+# Map from (version, error type) to (type name, code map), filled from the
+# ofp_*_code_map dicts of loxi the first time an error of a version is seen
+error_tables = {}
+error_table_versions = set()
+
+def error_names(version, err_type, code):
+    """
+    Look up the names of an error type and code
+
+    @returns A pair (type_str, code_str); unknown values are "unknown"
+    """
+    if version not in error_table_versions:
+        ofp = loxi.protocol(version)
+        for t, name in ofp.ofp_error_type_map.items():
+            map_name = "ofp_" + name[len("OFPET_"):].lower() + "_code_map"
+            error_tables[(version, t)] = (name, getattr(ofp, map_name, {}))
+        error_table_versions.add(version)
+
+    entry = error_tables.get((version, err_type))
+    if entry is None:
+        return ("unknown", "unknown")
+    type_str, code_map = entry
+    return (type_str, code_map.get(code, "unknown"))
+
+def packet_in_fields(rawmsg, version):
+    """
+    Extract fields of a packed packet in without decoding it
+
+    @param rawmsg The packed packet in message
+    @param version The OpenFlow version of the message
+    @returns A tuple (in_port, reason, data).  in_port is None if an
+    OpenFlow 1.2+ match does not include it.
+    @raises struct.error if the message is truncated
+    """
+    if version == 1:
+        in_port, reason = struct.unpack_from("!HB", rawmsg, 14)
+        return (in_port, reason, rawmsg[18:])
+    if version == 2:
+        in_port, = struct.unpack_from("!L", rawmsg, 12)
+        reason, = struct.unpack_from("!B", rawmsg, 22)
+        return (in_port, reason, rawmsg[24:])
+
+    reason, = struct.unpack_from("!B", rawmsg, 14)
+    if version == 3:
+        match_offset = 16
+    else:
+        match_offset = 24 # After the cookie
+    match_type, match_length = struct.unpack_from("!HH", rawmsg, match_offset)
+
+    in_port = None
+    offset = match_offset + 4
+    while offset + 4 <= match_offset + match_length:
+        oxm_header, = struct.unpack_from("!L", rawmsg, offset)
+        if oxm_header == OXM_IN_PORT:
+            in_port, = struct.unpack_from("!L", rawmsg, offset + 4)
+            break
+        offset += 4 + (oxm_header & 0xff)
+
+    # The match is padded to 8 bytes and followed by 2 bytes of padding
+    data_offset = match_offset + (match_length + 7) // 8 * 8 + 2
+    if data_offset > len(rawmsg):
+        raise struct.error("packet in truncated")
+    return (in_port, reason, rawmsg[data_offset:])
+
+def unwrap(msg):
+    """
+    Return the decoded message object for a possibly lazy message
+    """
+    if isinstance(msg, LazyMessage):
+        return msg.decode()
+    return msg
+
+def message_isinstance(msg, klass):
+    """
+    isinstance for possibly lazy messages
+
+    A LazyMessage is only decoded if klass is more specific than the
+    class of its message type.
+    """
+    if isinstance(msg, LazyMessage):
+        if not msg.decoded and msg.base_class() is klass:
+            return True
+        msg = msg.decode()
+    return isinstance(msg, klass)
+
+class MessageQueue(object):
+    """
+    Queue of received messages indexed by message type
+
+    Messages are kept in one deque per OpenFlow message type, plus a
+    deque recording the global arrival order.  Taking the oldest message
+    of a given type, or the oldest message overall, is O(1) amortized.
+
+    Entries taken out of a per-type deque are only marked dead in the
+    arrival order deque and skipped lazily; it is compacted when dead
+    entries outnumber live ones.
+
+    Each message has a sequence number.  A message appended with a
+    sequence number below that of queued messages, such as one a
+    dispatch worker passed on after later messages were queued, is
+    inserted in sequence order rather than at the tail.
+
+    Messages may be LazyMessage objects; they are decoded only when
+    checking against a subclass of their message type, and when they
+    are returned.  Messages that fail to decode are removed from the
+    queue when they are found and reported to on_parse_error; they are
+    never returned.
+
+    The queue is bounded by per-type quotas and a shared limit.  A type
+    with a quota is a ring of that size: when it is full its oldest
+    message is dropped, and it does not count against the shared limit.
+    Other types share the limit given to append.  When it is reached,
+    the oldest message of the lowest priority type present is dropped,
+    as long as its priority is not above that of the new message;
+    otherwise the new message is dropped.
+
+    Not thread safe; the controller protects it with packets_cv.
+
+    @var quotas Dict from message type to max queued messages
+    @var priorities Dict from message type to priority; missing types
+    have QUEUE_PRIORITY_REPLY
+    @var on_parse_error If not None, called for each message removed
+    because it could not be decoded
+    """
+
+    # Entry layout: [msg, pkt, msg type, sequence number, live, counted
+    # against the shared limit]
+    MSG, PKT, TYPE, SEQ, LIVE, SHARED = range(6)
+
+    def __init__(self, quotas=None, priorities=None, on_parse_error=None):
+        self.order = deque()
+        self.by_type = {}
+        self.count = 0
+        self.shared = 0 # Messages counted against the shared limit
+        self.dead = 0
+        self.seq = 0
+        if quotas is None:
+            quotas = {}
+        if priorities is None:
+            priorities = QUEUE_PRIORITIES
+        self.quotas = quotas
+        self.priorities = priorities
+        self.on_parse_error = on_parse_error
+
+    def __len__(self):
+        return self.count
+
+    def __nonzero__(self):
+        return self.count > 0
+
+    def __iter__(self):
+        """
+        Iterate over (msg, pkt) pairs in arrival order
+
+        Messages that cannot be decoded are skipped; they are removed by
+        the next pop or grab reaching them.
+        """
+        for entry in self.order:
+            if entry[self.LIVE]:
+                msg = unwrap(entry[self.MSG])
+                if msg is not None:
+                    yield (msg, entry[self.PKT])
+
+    def append(self, msg, pkt, limit=None, seq=None):
+        """
+        Add a message to the queue
+
+        @param limit The max number of queued messages of types without
+        a quota, or None for no limit
+        @param seq The sequence number of the message, or None to add it
+        at the tail
+        @returns The type of the message dropped to stay within bounds,
+        which may be the new one, or None
+        """
+        if seq is None:
+            seq = self.seq
+        self.seq = max(self.seq, seq + 1)
+        msg_type = msg.type
+        queue = self.by_type.get(msg_type)
+        dropped = None
+        quota = self.quotas.get(msg_type)
+        if quota is not None:
+            if quota <= 0:
+                return msg_type
+            if queue and len(queue) >= quota:
+                if seq < queue[0][self.SEQ]:
+                    # The new message is the oldest of its ring
+                    return msg_type
+                self._kill(queue.popleft())
+                dropped = msg_type
+        elif limit is not None and self.shared >= limit:
+            victim = self._victim(self.priorities.get(msg_type,
+                                                      QUEUE_PRIORITY_REPLY))
+            if victim is None:
+                return msg_type
+            dropped = victim[0][self.TYPE]
+            self._kill(victim.popleft())
+
+        entry = [msg, pkt, msg_type, seq, True, quota is None]
+        self._insert(self.order, entry)
+        if queue is None:
+            queue = self.by_type[msg_type] = deque()
+        self._insert(queue, entry)
+        self.count += 1
+        if quota is None:
+            self.shared += 1
+        return dropped
+
+    def _insert(self, queue, entry):
+        # Add an entry to a deque sorted by sequence number; entries are
+        # rarely out of order, so search from the tail
+        seq = entry[self.SEQ]
+        i = len(queue)
+        while i > 0 and queue[i - 1][self.SEQ] > seq:
+            i -= 1
+        if i == len(queue):
+            queue.append(entry)
+        else:
+            queue.rotate(-i)
+            queue.appendleft(entry)
+            queue.rotate(i)
+
+    def _victim(self, priority):
+        # The type queue holding the message to drop for one of this
+        # priority, or None
+        found = None
+        for msg_type, queue in self.by_type.items():
+            if not queue or not queue[0][self.SHARED]:
+                continue
+            key = (self.priorities.get(msg_type, QUEUE_PRIORITY_REPLY),
+                   queue[0][self.SEQ])
+            if key[0] <= priority and (found is None or key < found[0]):
+                found = (key, queue)
+        return found and found[1]
+
+    def pop(self, index=0):
+        """
+        Remove and return the oldest (msg, pkt) pair
+
+        The index argument exists for compatibility with code that treated
+        the queue as a list; only the head of the queue can be popped.
+        """
+        if index != 0:
+            raise IndexError("only the oldest message can be popped")
+        while self.order:
+            entry = self.order.popleft()
+            if entry[self.LIVE]:
+                # The oldest live entry is also the head of its type queue
+                self.by_type[entry[self.TYPE]].popleft()
+                entry[self.LIVE] = False
+                self.count -= 1
+                if entry[self.SHARED]:
+                    self.shared -= 1
+                msg = unwrap(entry[self.MSG])
+                if msg is not None:
+                    return (msg, entry[self.PKT])
+                self._parse_error()
+            else:
+                self.dead -= 1
+        raise IndexError("pop from empty queue")
+
+    def grab(self, klass=None):
+        """
+        Remove and return the oldest message that is an instance of klass
+
+        @param klass A message class, or None to take the oldest message
+        @returns A pair (msg, pkt), or None if no message matches
+        """
+        if klass is None:
+            try:
+                return self.pop(0)
+            except IndexError:
+                return None
+
+        msg_type = getattr(klass, 'type', None)
+        while True:
+            if msg_type is None:
+                # Abstract class without a message type; check every queue
+                candidates = self.by_type.values()
+            else:
+                candidates = [self.by_type.get(msg_type) or ()]
+
+            found = None
+            undecodable = []
+            for queue in candidates:
+                for entry in queue:
+                    if message_isinstance(entry[self.MSG], klass):
+                        if found is None or \
+                                entry[self.SEQ] < found[1][self.SEQ]:
+                            found = (queue, entry)
+                        break
+                    if unwrap(entry[self.MSG]) is None:
+                        undecodable.append((queue, entry))
+            for queue, entry in undecodable:
+                self._remove(queue, entry)
+                self._parse_error()
+            if found is None:
+                return None
+
+            # A message matched by its type alone may still fail to decode
+            (queue, entry) = found
+            self._remove(queue, entry)
+            msg = unwrap(entry[self.MSG])
+            if msg is not None:
+                return (msg, entry[self.PKT])
+            self._parse_error()
+
+    def clear(self):
+        """
+        Remove all messages
+        """
+        self.order.clear()
+        self.by_type.clear()
+        self.count = 0
+        self.shared = 0
+        self.dead = 0
+
+    def _remove(self, queue, entry):
+        # Take a live entry out of its type queue
+        if queue[0] is entry:
+            queue.popleft()
+        else:
+            for i, e in enumerate(queue):
+                if e is entry:
+                    del queue[i]
+                    break
+        self._kill(entry)
+
+    def _parse_error(self):
+        if self.on_parse_error:
+            self.on_parse_error()
+
+    def _kill(self, entry):
+        entry[self.LIVE] = False
+        self.count -= 1
+        if entry[self.SHARED]:
+            self.shared -= 1
+        self.dead += 1
+        if self.dead > self.count + 64:
+            self.order = deque(e for e in self.order if e[self.LIVE])
+            self.dead = 0
+
+class MultipartStream(object):
+    """
+    The replies to a multipart request
+
+    Created by Connection.multipart.  The controller thread adds each
+    reply with the xid of the request; iterating yields (msg, pkt) pairs
+    in order, waiting for the next reply as needed.  Iteration ends after
+    the reply without the "more" flag, an error reply, cancellation, a
+    reply that could not be parsed, in which case parse_error is set, or
+    a timeout, in which case timed_out is set.
+
+    Replies are only held until the iterator takes them, so the memory
+    used does not depend on the total size of the response.
+
+    @var xid The transaction id of the request
+    @var msg_type The message type of the request
+    @var timeout Seconds to wait for each reply; -1 for the default
+    @var timed_out True if iteration ended because a reply did not arrive
+    @var parse_error True if iteration ended because a reply could not be
+    parsed; the rest of the response is lost
+    """
+
+    def __init__(self, connection, xid, msg_type=None, timeout=-1):
+        self.connection = connection
+        self.xid = xid
+        self.msg_type = msg_type
+        self.timeout = timeout
+        self.timed_out = False
+        self.parse_error = False
+        self.replies = deque()
+        self.finished = False
+        self.cv = Condition()
+
+    def deliver(self, msg, pkt):
+        """
+        Add a reply
+
+        @param msg The reply message object, or None if it could not be
+        parsed, which ends the stream
+        @returns False if this was the last reply
+        """
+        if msg is None:
+            with self.cv:
+                self.parse_error = True
+                self.finished = True
+                self.cv.notify_all()
+            return False
+        more = getattr(msg, "flags", 0) & MULTIPART_REPLY_MORE
+        with self.cv:
+            self.replies.append((msg, pkt))
+            if not more:
+                self.finished = True
+            self.cv.notify_all()
+        return bool(more)
+
+    def cancel(self):
+        """
+        End the stream without further replies
+        """
+        with self.cv:
+            self.finished = True
+            self.cv.notify_all()
+
+    def close(self):
+        """
+        Stop collecting replies
+        """
+        self.connection.stream_remove(self)
+        self.cancel()
+
+    def __iter__(self):
+        while True:
+            with self.cv:
+                ret = ofutils.timed_wait(self.cv, self._next,
+                                         timeout=self.timeout)
+            if ret is None:
+                self.timed_out = True
+                self.close()
+                return
+            if ret is self:
+                return
+            yield ret
+
+    def _next(self):
+        # Returns the next reply, self at the end, or None to keep waiting
+        if self.replies:
+            return self.replies.popleft()
+        if self.finished:
+            return self
+        return None
+
+class EventStream(object):
+    """
+    Asynchronous messages of one type, such as flow removed or port status
+
+    Created by Connection.event_stream.  The controller thread adds each
+    received message accepted by the filter to a ring of bounded size;
+    when the ring is full the oldest event is dropped and counted.
+    Events are taken with get, or by iterating, which waits for events
+    until a deadline:
+
+        stream = self.controller.flow_removed_stream(cookie_range(1, 1000))
+        for msg, pkt in stream.iter(timeout=10, count=1000):
+            ...
+        stream.close()
+
+    @var msg_type The message type number
+    @var filter Predicate taking the message object, or None for all
+    @var callback If not None, called as callback(msg, pkt) for each
+    event instead of adding it to the ring
+    @var received Number of events accepted
+    @var dropped Number of events dropped because the ring was full
+    """
+
+    def __init__(self, connection, msg_type, filter=None,
+                 size=EVENT_STREAM_SIZE, callback=None):
+        self.connection = connection
+        self.msg_type = msg_type
+        self.filter = filter
+        self.callback = callback
+        self.events = deque(maxlen=size)
+        self.received = 0
+        self.dropped = 0
+        self.closed = False
+        self.cv = Condition()
+
+    def __len__(self):
+        return len(self.events)
+
+    def matches(self, msg):
+        return self.filter is None or self.filter(msg)
+
+    def deliver(self, msg, pkt):
+        """
+        Add an event
+        """
+        if self.callback:
+            self.received += 1
+            self.callback(msg, pkt)
+            return
+        with self.cv:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append((msg, pkt))
+            self.received += 1
+            self.cv.notify_all()
+
+    def get(self, timeout=-1):
+        """
+        Take the oldest event, waiting for one if needed
+
+        @param timeout Seconds to wait; -1 for the default
+        @returns A pair (msg, pkt), or (None, None) on timeout or if the
+        stream is closed
+        """
+        with self.cv:
+            ret = ofutils.timed_wait(self.cv, self._next, timeout=timeout)
+        if ret is None or ret is self:
+            return (None, None)
+        return ret
+
+    def iter(self, timeout=-1, count=None):
+        """
+        Yield events as (msg, pkt) pairs until count have been taken,
+        the deadline timeout seconds from now passes, or the stream is
+        closed
+
+        @param timeout Seconds until the deadline; -1 for the default
+        @param count Number of events to take, or None for no limit
+        """
+        if timeout == -1:
+            timeout = ofutils.default_timeout
+        deadline = time.time() + timeout
+        taken = 0
+        while count is None or taken < count:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            with self.cv:
+                ret = ofutils.timed_wait(self.cv, self._next,
+                                         timeout=remaining)
+            if ret is None or ret is self:
+                return
+            taken += 1
+            yield ret
+
+    def __iter__(self):
+        return self.iter()
+
+    def close(self):
+        """
+        Stop receiving events and wake up waiters
+
+        Events already in the ring can still be taken.
+        """
+        self.connection.event_stream_remove(self)
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
+
+    def _next(self):
+        # Returns the next event, self once closed and empty, or None to
+        # keep waiting
+        if self.events:
+            return self.events.popleft()
+        if self.closed:
+            return self
+        return None
+
+def cookie_range(low, high):
+    """
+    Event stream filter accepting messages with low <= cookie <= high
+    """
+    return lambda msg: low <= msg.cookie <= high
+
+class HandlerStats(object):
+    """
+    Timing counters for a message handler
+
+    @var handler The handler function
+    @var calls Number of calls
+    @var total Total time spent in the handler, in seconds
+    @var max Longest single call, in seconds
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, elapsed):
+        self.calls += 1
+        self.total += elapsed
+        if elapsed > self.max:
+            self.max = elapsed
+
+    def __str__(self):
+        if self.calls:
+            avg = self.total / self.calls
+        else:
+            avg = 0.0
+        name = getattr(self.handler, "__name__", repr(self.handler))
+        return "%s calls %d total %.6fs avg %.6fs max %.6fs" % \
+            (name, self.calls, self.total, avg, self.max)
+
+class Dispatcher(object):
+    """
+    Pool of threads calling message handlers off the receive thread
+
+    All messages of one connection go to the same worker, so its
+    handlers see them in order.  The receive thread never waits for a
+    worker.  Data messages are dropped and counted when the worker's
+    queue already holds queue_size messages; other messages are always
+    queued, so replies and control messages are not lost to a data
+    flood.  A warning is logged each time they take a queue past
+    queue_size.
+
+    @var workers Number of worker threads
+    @var queue_size Length of a worker's queue at which data messages
+    are dropped
+    @var dispatched Number of messages handed to workers
+    @var dropped Number of data messages dropped because a queue was full
+    @var queue_high Largest length of a worker queue
+    @var errors Number of exceptions raised by handlers
+    """
+
+    def __init__(self, workers, queue_size=DISPATCH_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.logger = logging.getLogger("controller")
+        self.queues = [Queue.Queue() for i in range(workers)]
+        self.threads = []
+        self.dispatched = 0
+        self.dropped = 0
+        self.queue_high = 0
+        self.errors = 0
+
+    def start(self):
+        for q in self.queues:
+            thread = Thread(target=self._run, args=(q,), name="dispatch")
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """
+        Let the workers finish the queued messages and exit
+        """
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def put(self, cxn, msg, rawmsg, seq=None, data=False):
+        """
+        Queue a message for the worker of its connection
+
+        @param seq The receive sequence number of the message
+        @param data If true, drop the message when the worker's queue is
+        full
+        @returns False if the message was dropped
+        """
+        q = self.queues[cxn.id % self.workers]
+        length = q.qsize()
+        if data and length >= self.queue_size:
+            self.dropped += 1
+            return False
+        q.put_nowait((cxn, msg, rawmsg, seq))
+        self.dispatched += 1
+        length += 1
+        if length == self.queue_size + 1:
+            self.logger.warning("Dispatch queue above %d messages; "
+                                "handlers are falling behind", self.queue_size)
+        if length > self.queue_high:
+            self.queue_high = length
+        return True
+
+    def _run(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            cxn, msg, rawmsg, seq = item
+            try:
+                cxn._dispatch(msg, rawmsg, seq)
+            except:
+                self.errors += 1
+                self.logger.exception("Message handler failed")
+            finally:
+                cxn._dispatch_finished()
+
+    def __str__(self):
+        return "workers %d queued %d dispatched %d dropped %d queue_high %d errors %d" % \
+            (self.workers, sum(q.qsize() for q in self.queues),
+             self.dispatched, self.dropped, self.queue_high, self.errors)
+
+class Transaction(object):
+    """
+    A request sent to the switch that is waiting for its reply
+
+    Created by Connection.transact_async.  The controller thread completes
+    the transaction when a message with a matching xid is received.
+
+    @var xid The transaction id of the request
+    @var msg_type The message type of the request
+    @var response A pair (msg, pkt) once completed, otherwise None
+    """
+
+    def __init__(self, connection, xid, msg_type=None):
+        self.connection = connection
+        self.xid = xid
+        self.msg_type = msg_type
+        self.response = None
+        self.cv = Condition()
+
+    def complete(self, msg, pkt):
+        """
+        Record the reply and wake up the waiter
+        """
+        with self.cv:
+            self.response = (msg, pkt)
+            self.cv.notify_all()
+
+    def cancel(self):
+        """
+        Wake up the waiter without a reply
+        """
+        self.complete(None, None)
+
+    def done(self):
+        """
+        @returns Boolean, True if a reply was received or the transaction
+        was cancelled
+        """
+        return self.response is not None
+
+    def wait(self, timeout=-1):
+        """
+        Wait for the reply
+
+        @param timeout The timeout in seconds; if -1 use default.
+        @retval A pair (msg, pkt) as returned by Controller.transact.
+        If no reply was received (None, None) is returned.
+        """
+        with self.cv:
+            ofutils.timed_wait(self.cv, lambda: self.response, timeout=timeout)
+        self.connection.transaction_remove(self)
+        return self.response or (None, None)
+
 def sample_handler(controller, msg, pkt):
     """
     Sample message handler
@@ -726,7 +2618,8 @@ def sample_handler(controller, msg, pkt):
     This is the prototype for functions registered with the controller
     class for packet reception
 
-    @param controller The controller calling the handler
+    @param controller The Connection calling the handler.  It provides
+    the same message_send, transact and poll methods as the controller.
     @param msg The parsed message object
     @param pkt The raw packet that was received on the socket.  This is
     in case the packet contains extra unparsed data.
@@ -17,14 +17,16 @@ for filters should include a callback or a counter
 import sys
 import os
 import socket
+import inspect
 import time
-import select
 import logging
+from collections import deque
 from threading import Thread
 from threading import Lock
 from threading import Condition
 import ofutils
 import netutils
+import reactor
 from pcap_writer import PcapWriter
 
 if "linux" in sys.platform:
@@ -62,6 +64,7 @@ class DataPlanePortLinux:
         self.interface_name = interface_name
         self.socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
         afpacket.enable_auxdata(self.socket)
+        self.receiver = afpacket.Receiver(self.socket, self.RCV_SIZE_DEFAULT)
         self.socket.bind((interface_name, self.ETH_P_ALL))
         netutils.set_promisc(self.socket, interface_name)
         self.socket.settimeout(self.RCV_TIMEOUT)
@@ -79,10 +82,21 @@ class DataPlanePortLinux:
     def recv(self):
         """
         Receive a packet from this port.
-        @retval (packet data, timestamp)
+        @retval (packet data, timestamp), or (None, None) if no packet is
+        waiting
         """
-        pkt = afpacket.recv(self.socket, self.RCV_SIZE_DEFAULT)
-        return (pkt, time.time())
+        pkts = self.receiver.recv(1)
+        if not pkts:
+            return (None, None)
+        return (pkts[0], time.time())
+
+    def recv_many(self):
+        """
+        Receive the packets waiting on this port, up to a batch.
+        @retval List of (packet data, timestamp)
+        """
+        timestamp = time.time()
+        return [(pkt, timestamp) for pkt in self.receiver.recv()]
 
     def send(self, packet):
         """
@@ -92,6 +106,14 @@ class DataPlanePortLinux:
         """
         return self.socket.send(packet)
 
+    def send_many(self, packets):
+        """
+        Send several packets out this port with sendmmsg.
+        @param packets List of packet data strings
+        @retval The number of packets sent
+        """
+        return afpacket.send_many(self.socket, packets)
+
     def down(self):
         """
         Bring the physical link down.
@@ -105,6 +127,62 @@ class DataPlanePortLinux:
         os.system("ifconfig up %s" % self.interface_name)
 
 
+class DataPlanePortLinuxRing(DataPlanePortLinux):
+    """
+    Linux port receiving through a memory-mapped TPACKET_V3 ring.
+
+    Packets are copied out of blocks shared with the kernel instead of
+    being read with a recvmsg call each, which keeps up with higher
+    packet rates.  Timestamps are taken by the kernel on arrival.
+    """
+
+    def __init__(self, interface_name, port_number,
+                 block_size=None, block_nr=None, retire_tov=None):
+        """
+        @param interface_name The name of the physical interface like eth1
+        @param block_size Size of a ring block in bytes; a multiple of
+        the page size
+        @param block_nr Number of ring blocks
+        @param retire_tov Milliseconds before a partly filled block is
+        delivered
+        """
+        self.interface_name = interface_name
+        self.socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, 0)
+        self.ring = afpacket.RxRing(self.socket,
+            block_size=block_size or afpacket.RING_BLOCK_SIZE,
+            block_nr=block_nr or afpacket.RING_BLOCK_NR,
+            retire_tov=retire_tov or afpacket.RING_RETIRE_TOV)
+        self.socket.bind((interface_name, self.ETH_P_ALL))
+        netutils.set_promisc(self.socket, interface_name)
+        self.socket.settimeout(self.RCV_TIMEOUT)
+
+    def __del__(self):
+        if self.socket:
+            self.ring.close()
+            self.socket.close()
+
+    def recv(self):
+        """
+        Receive a packet from this port.
+        @retval (packet data, timestamp), or (None, None) if no packet is
+        waiting in the ring
+        """
+        return self.ring.recv()
+
+    def recv_many(self):
+        """
+        Receive the packets waiting in the ring, up to a batch.
+        @retval List of (packet data, timestamp)
+        """
+        result = []
+        while len(result) < afpacket.RECV_BATCH:
+            pkt, timestamp = self.ring.recv()
+            if pkt is None:
+                break
+            result.append((pkt, timestamp))
+        return result
+
+
 class DataPlanePortPcap:
     """
     Alternate port implementation using libpcap. This is used by non-Linux
@@ -141,19 +219,49 @@ class DataPlane(Thread):
     interface, to do IO on a particular port. A background thread is used to
     read packets from the dataplane ports and enqueue them to be read by the
     test. The kill() method must be called to shutdown this thread.
+
+    Each port has a bounded queue of received packets.  When it is full
+    the oldest packet is dropped.  Drops and the largest queue length
+    seen are counted per port in queue_drops and queue_high.
+
+    The entries of all port queues are also kept in one deque in the
+    order they were read, so the oldest packet from any port is found in
+    O(1).  Packets of ports ready in the same wakeup are in the order the
+    ports were read, not ordered by timestamp.  Entries
+    taken from a port queue directly are only marked dead there and
+    skipped lazily; the deque is compacted when dead entries outnumber
+    live ones.
     """
 
     MAX_QUEUE_LEN = 100
 
+    # Queue entry layout: [packet, timestamp, port number, live]
+    PKT, TIME, PORT, LIVE = range(4)
+
     def __init__(self, config=None):
         Thread.__init__(self)
 
         # dict from port number to port object
         self.ports = {}
 
-        # dict from port number to list of (timestamp, packet)
+        # dict from port number to deque of queue entries
         self.packet_queues = {}
 
+        # Queue entries of all ports in the order they were read, and the
+        # number of them that are dead
+        self.arrivals = deque()
+        self.arrivals_dead = 0
+
+        # Queue depth: the default, and dict from port number to the
+        # depth of ports set with queue_len_set
+        self.queue_len = self.MAX_QUEUE_LEN
+        self.queue_lens = {}
+
+        # dicts from port number to the number of packets dropped from
+        # its full queue, and to the largest length of its queue
+        self.queue_drops = {}
+        self.queue_high = {}
+
         # cvar serves double duty as a regular top level lock and
         # as a condition variable
         self.cvar = Condition()
@@ -170,6 +278,10 @@ class DataPlane(Thread):
         else:
             self.config = config; 
 
+        if self.config.get("dataplane_queue_len"):
+            self.queue_len = self.config["dataplane_queue_len"]
+        self.queue_len_default = self.queue_len
+
         ############################################################
         #
         # The platform/config can provide a custom DataPlanePort class
@@ -187,49 +299,92 @@ class DataPlane(Thread):
         else:
             self.dppclass = DataPlanePortPcap
 
+        # Extra arguments for the port class; the ring geometry of
+        # DataPlanePortLinuxRing comes from the rx_ring_* config
+        self.dpp_args = {}
+        if inspect.isclass(self.dppclass) and \
+                issubclass(self.dppclass, DataPlanePortLinuxRing):
+            self.dpp_args = dict(
+                block_size=self.config.get("rx_ring_block_size"),
+                block_nr=self.config.get("rx_ring_block_nr"),
+                retire_tov=self.config.get("rx_ring_retire_tov"))
+
+        # Likewise config.dataplane.reactor selects the event loop
+        # implementation; see reactor.py. Ports are registered with it
+        # in port_add and unregistered in port_del.
+        if "dataplane" in self.config and "reactor" in self.config["dataplane"]:
+            self.reactor = self.config["dataplane"]["reactor"]()
+        else:
+            self.reactor = reactor.DefaultReactor()
+        self.reactor.register(self.waker)
+
         self.start()
 
     def run(self):
         """
         Activity function for class
+
+        Ports with a recv_many method are drained in batches.  Packets
+        received in one wakeup are enqueued together under a single
+        acquisition of cvar.
         """
         while not self.killed:
-            sockets = [self.waker] + self.ports.values()
             try:
-                sel_in, sel_out, sel_err = select.select(sockets, [], [], 1)
+                sel_in, sel_err = self.reactor.poll()
             except:
                 print sys.exc_info()
                 self.logger.error("Select error, exiting")
                 break
 
-            with self.cvar:
-                for port in sel_in:
-                    if port == self.waker:
-                        self.waker.wait()
-                        continue
+            received = [] # (port number, packet, timestamp)
+            for port in sel_in + sel_err:
+                if port == self.waker:
+                    self.waker.wait()
+                    continue
+                try:
+                    if hasattr(port, "recv_many"):
+                        pkts = port.recv_many()
                     else:
-                        # Enqueue packet
-                        try:
-                            pkt, timestamp = port.recv()
-                        except OSError as e:
-                            # the afpacket.py will assert except raising OSError if e.errno is ENETDOWN 
-                            # remove socket from sel_in
-                            self.port_del(port.interface_name, port._port_number)
-                            continue
-
-                        port_number = port._port_number
-                        self.logger.debug("Pkt len %d in on port %d",
-                                          len(pkt), port_number)
-                        if self.pcap_writer:
-                            self.pcap_writer.write(pkt, timestamp, port_number)
-                        queue = self.packet_queues[port_number]
-                        if len(queue) >= self.MAX_QUEUE_LEN:
-                            # Queue full, throw away oldest
-                            queue.pop(0)
-                            self.logger.debug("Discarding oldest packet to make room")
-                        queue.append((pkt, timestamp))
+                        pkts = [port.recv()]
+                except OSError as e:
+                    # the afpacket.py will assert except raising OSError if e.errno is ENETDOWN 
+                    # remove socket from sel_in
+                    self.port_del(port.interface_name, port._port_number)
+                    continue
+
+                port_number = port._port_number
+                for (pkt, timestamp) in pkts:
+                    # Ring ports may be polled before a block is ready
+                    if pkt is not None:
+                        received.append((port_number, pkt, timestamp))
+
+            if not received:
+                continue
+
+            if self.pcap_writer:
+                self.pcap_writer.write_many([(pkt, timestamp, port_number)
+                    for (port_number, pkt, timestamp) in received])
+
+            with self.cvar:
+                for (port_number, pkt, timestamp) in received:
+                    self.logger.debug("Pkt len %d in on port %d",
+                                      len(pkt), port_number)
+                    queue = self.packet_queues[port_number]
+                    if len(queue) == queue.maxlen:
+                        # Queue full, the deque throws away the oldest
+                        if not self.queue_drops[port_number]:
+                            self.logger.warning("Port %d queue full (%d packets), discarding oldest packets",
+                                                port_number, queue.maxlen)
+                        self.queue_drops[port_number] += 1
+                        self._kill(queue[0])
+                    entry = [pkt, timestamp, port_number, True]
+                    queue.append(entry)
+                    self.arrivals.append(entry)
+                    if len(queue) > self.queue_high[port_number]:
+                        self.queue_high[port_number] = len(queue)
                 self.cvar.notify_all()
 
+        self.reactor.close()
         self.logger.info("Thread exit")
 
     def port_add(self, interface_name, port_number):
@@ -239,9 +394,15 @@ class DataPlane(Thread):
         @param port_number The port number used to refer to the port
         Stashes the port number on the created port object.
         """
-        self.ports[port_number] = self.dppclass(interface_name, port_number)
+        self.ports[port_number] = self.dppclass(interface_name, port_number,
+                                                **self.dpp_args)
         self.ports[port_number]._port_number = port_number
-        self.packet_queues[port_number] = []
+        with self.cvar:
+            self.packet_queues[port_number] = \
+                deque(maxlen=self.queue_lens.get(port_number, self.queue_len))
+            self.queue_drops[port_number] = 0
+            self.queue_high[port_number] = 0
+        self.reactor.register(self.ports[port_number])
         # Need to wake up event loop to change the sockets being selected on.
         self.waker.notify()
 
@@ -251,6 +412,7 @@ class DataPlane(Thread):
         @param interface_name The name of the physical interface like eth1
         @param port_number The port number used to refer to the port
         """
+        self.reactor.unregister(self.ports[port_number])
         del self.ports[port_number]
         # Need to wake up event loop to change the sockets being selected on.
         self.waker.notify()
@@ -271,38 +433,103 @@ class DataPlane(Thread):
                      (bytes, len(packet)))
         return bytes
 
+    def send_many(self, port_number, packets):
+        """
+        Send a burst of packets to the given port
+
+        Uses the send_many method of the port if it has one, which sends
+        the whole burst with a few system calls.  The burst is written to
+        the pcap file at once.
+        @param port_number The port to send the data to
+        @param packets List of raw packet data to send to port
+        @retval The number of packets sent
+        """
+        return self.send_burst([(port_number, packet) for packet in packets])
+
+    def send_burst(self, burst):
+        """
+        Send a burst of packets to several ports
+
+        Packets to the same port are sent in order, but the order between
+        ports is not kept: the packets of each port are sent together.
+        @param burst List of (port number, raw packet data)
+        @retval The number of packets sent
+        """
+        by_port = {}
+        order = []
+        for (port_number, packet) in burst:
+            if port_number not in by_port:
+                by_port[port_number] = []
+                order.append(port_number)
+            by_port[port_number].append(packet)
+
+        if self.pcap_writer:
+            timestamp = time.time()
+            self.pcap_writer.write_many([(packet, timestamp, port_number)
+                                         for (port_number, packet) in burst])
+
+        sent = 0
+        for port_number in order:
+            packets = by_port[port_number]
+            self.logger.debug("Sending %d packets to port %d" %
+                              (len(packets), port_number))
+            port = self.ports[port_number]
+            if hasattr(port, "send_many"):
+                count = port.send_many(packets)
+            else:
+                count = 0
+                for packet in packets:
+                    if port.send(packet) == len(packet):
+                        count += 1
+            if count != len(packets):
+                self.logger.error("Unhandled send error, sent %d of %d packets" %
+                                  (count, len(packets)))
+            sent += count
+        return sent
+
     def oldest_port_number(self):
         """
         Returns the port number with the oldest packet, or
         None if no packets are queued.
         """
-        min_port_number = None
-        min_time = float('inf')
-        for (port_number, queue) in self.packet_queues.items():
-            if queue and queue[0][1] < min_time:
-                min_time = queue[0][1]
-                min_port_number = port_number
-        return min_port_number
+        while self.arrivals and not self.arrivals[0][self.LIVE]:
+            self.arrivals.popleft()
+            self.arrivals_dead -= 1
+        if not self.arrivals:
+            return None
+        return self.arrivals[0][self.PORT]
 
     # Dequeues and yields packets in the order they were received.
     # Yields (port number, packet, received time).
     # If port_number is not specified yields packets from all ports.
     def packets(self, port_number=None):
         while True:
-            rcv_port_number = port_number or self.oldest_port_number()
-
-            if rcv_port_number == None:
-                self.logger.debug("Out of packets on all ports")
-                break
-
-            queue = self.packet_queues[rcv_port_number]
-
-            if len(queue) == 0:
-                self.logger.debug("Out of packets on port %d", rcv_port_number)
-                break
-
-            pkt, time = queue.pop(0)
-            yield (rcv_port_number, pkt, time)
+            if port_number:
+                queue = self.packet_queues[port_number]
+                if len(queue) == 0:
+                    self.logger.debug("Out of packets on port %d", port_number)
+                    break
+                entry = queue.popleft()
+                self._kill(entry)
+            else:
+                rcv_port_number = self.oldest_port_number()
+                if rcv_port_number == None:
+                    self.logger.debug("Out of packets on all ports")
+                    break
+                # The oldest entry is also the head of its port queue
+                self.packet_queues[rcv_port_number].popleft()
+                entry = self.arrivals.popleft()
+                entry[self.LIVE] = False
+
+            yield (entry[self.PORT], entry[self.PKT], entry[self.TIME])
+
+    def _kill(self, entry):
+        # Mark an entry removed from its port queue dead in arrivals
+        entry[self.LIVE] = False
+        self.arrivals_dead += 1
+        if self.arrivals_dead > len(self.arrivals) - self.arrivals_dead + 64:
+            self.arrivals = deque(e for e in self.arrivals if e[self.LIVE])
+            self.arrivals_dead = 0
 
     def poll(self, port_number=None, timeout=-1, exp_pkt=None):
         """
@@ -369,9 +596,59 @@ class DataPlane(Thread):
     def flush(self):
         """
         Drop any queued packets.
+
+        The drop and high-water counters are kept; see queue_stats_reset.
+        """
+        with self.cvar:
+            for port_number in self.packet_queues.keys():
+                self.packet_queues[port_number].clear()
+            self.arrivals.clear()
+            self.arrivals_dead = 0
+
+    def queue_stats_reset(self):
         """
-        for port_number in self.packet_queues.keys():
-            self.packet_queues[port_number] = []
+        Clear the drop and high-water counters of all ports.
+        """
+        with self.cvar:
+            for port_number in self.packet_queues.keys():
+                self.queue_drops[port_number] = 0
+                self.queue_high[port_number] = 0
+
+    def queue_len_set(self, length, port_number=None):
+        """
+        Set the depth of the packet queue of one port or of all ports
+
+        Queued packets are kept, except the oldest ones if there are more
+        than the new depth.
+        @param length The max number of queued packets, at least 1
+        @param port_number The port to change; if None, change the default
+        and every port not set individually.  A port that has not been
+        added yet gets the depth when port_add adds it.
+        """
+        if length < 1:
+            raise ValueError("Invalid dataplane queue length %r" % length)
+        with self.cvar:
+            if port_number is None:
+                self.queue_len = length
+                port_numbers = [x for x in self.packet_queues.keys()
+                                if x not in self.queue_lens]
+            else:
+                self.queue_lens[port_number] = length
+                port_numbers = [port_number] \
+                    if port_number in self.packet_queues else []
+            for x in port_numbers:
+                queue = self.packet_queues[x]
+                for i in range(len(queue) - length):
+                    self._kill(queue[i])
+                self.packet_queues[x] = deque(queue, maxlen=length)
+
+    def queue_len_reset(self):
+        """
+        Restore the configured depth of all packet queues
+        """
+        with self.cvar:
+            self.queue_lens = {}
+        self.queue_len_set(self.queue_len_default)
 
     def start_pcap(self, filename):
         assert(self.pcap_writer == None)
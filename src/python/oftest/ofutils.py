@@ -8,13 +8,118 @@ import time
 import os
 import fcntl
 import logging
+from threading import Lock
+from collections import OrderedDict
 
 default_timeout = None # set by oft
 default_negative_timeout = None # set by oft
 
+XID_MAX = 0xffffffff
+
+# Number of abandoned xids remembered to recognize late replies
+XID_EXPIRED_MAX = 1024
+
 def gen_xid():
     return random.randrange(1,0xffffffff)
 
+class XidAllocator(object):
+    """
+    Transaction id allocator for one connection
+
+    Xids are handed out from a counter that wraps from XID_MAX back to 1
+    (0 is left for unsolicited messages).  The counter starts at a random
+    value, like gen_xid, so it does not run into the small xids tests
+    set by hand.  Xids of requests waiting for a
+    reply are kept in an outstanding dict with the time the request was
+    sent; the counter skips them after wrapping, so an xid is never
+    reused while a reply to it may still arrive.
+
+    Outstanding xids released without a reply (timeouts) are remembered
+    for a while, so a reply arriving for one later can be recognized as
+    stale rather than mistaken for an unsolicited message.
+
+    @var outstanding Dict from outstanding xid to send time, or None if
+    not sent yet
+    @var expired Recently abandoned xids, oldest first
+    """
+
+    def __init__(self, start=None):
+        """
+        @param start The first xid; if None, a random one
+        """
+        self.lock = Lock()
+        if start is None:
+            start = gen_xid()
+        self.next_xid = start
+        self.outstanding = {}
+        self.expired = OrderedDict()
+
+    def next(self):
+        """
+        @returns The next xid that is not outstanding
+        """
+        with self.lock:
+            while True:
+                xid = self.next_xid
+                if xid >= XID_MAX:
+                    self.next_xid = 1
+                else:
+                    self.next_xid = xid + 1
+                if xid not in self.outstanding:
+                    return xid
+
+    def reserve(self, xid):
+        """
+        Mark an xid as waiting for a reply
+
+        @returns False if the xid is already outstanding
+        """
+        with self.lock:
+            if xid in self.outstanding:
+                return False
+            self.outstanding[xid] = None
+            self.expired.pop(xid, None)
+            return True
+
+    def sent(self, xid):
+        """
+        Record the send time of an outstanding xid
+        """
+        if xid in self.outstanding:
+            self.outstanding[xid] = time.time()
+
+    def release(self, xid, expired=False):
+        """
+        Stop tracking an outstanding xid
+
+        @param expired True if no reply was received; a later reply with
+        this xid will be reported by stale()
+        @returns The time the request was sent, or None
+        """
+        with self.lock:
+            sent = self.outstanding.pop(xid, None)
+            if expired:
+                self.expired[xid] = True
+                if len(self.expired) > XID_EXPIRED_MAX:
+                    self.expired.popitem(last=False)
+            return sent
+
+    def stale(self, xid):
+        """
+        Check for a late reply to an abandoned request
+
+        @returns True if xid was released as expired
+        """
+        with self.lock:
+            return xid in self.expired
+
+    def clear(self):
+        """
+        Release all outstanding xids as expired
+        """
+        for xid in list(self.outstanding):
+            self.release(xid, expired=True)
+
 """
 Wait on a condition variable until the given function returns non-None or a timeout expires.
 The condition variable must already be acquired.
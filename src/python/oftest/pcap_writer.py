@@ -1,14 +1,41 @@
 """
 Pcap file writer
+
+PcapWriter writes dataplane packets.  ControlCapture records the OpenFlow
+control channel, wrapping each message in synthesized Ethernet, IPv4 and
+TCP headers so that Wireshark dissects it as OpenFlow.
 """
 
 import struct
+import socket
+import time
+import logging
+import Queue
+from threading import Thread
 
 PcapHeader = struct.Struct("<LHHLLLL")
 PcapPktHeader = struct.Struct("<LLLL")
 PPIPktHeader = struct.Struct("<BBHL")
 PPIAggregateField = struct.Struct("<HHL")
 
+EthernetHeader = struct.Struct("!6s6sH")
+IPv4Header = struct.Struct("!BBHHHBBH4s4s")
+TCPHeader = struct.Struct("!HHLLBBHHH")
+
+# Largest TCP payload per synthesized segment; longer messages are split
+TCP_SEGMENT_SIZE = 16384
+
+# Messages waiting for the capture thread; more are dropped
+CAPTURE_QUEUE_SIZE = 8192
+
+# Addresses used when the real ones are not IPv4
+CAPTURE_LOCAL_ADDR = ("127.0.0.1", 6653)
+CAPTURE_REMOTE_ADDR = ("127.0.0.2", 1024)
+
+# MAC addresses of the synthesized frames
+CAPTURE_LOCAL_MAC = "\x02\x00\x00\x00\x00\x01"
+CAPTURE_REMOTE_MAC = "\x02\x00\x00\x00\x00\x02"
+
 class PcapWriter(object):
     def __init__(self, filename):
         """
@@ -34,25 +61,172 @@ class PcapWriter(object):
         'timestamp' should be a float.
         'port' should be an integer port number.
         """
+        self.stream.write(self._record(data, timestamp, port))
+
+    def write_many(self, records):
+        """
+        Write several packets to a pcap file with a single write
+
+        'records' should be a list of (data, timestamp, port) tuples as
+        passed to write.
+        """
+        self.stream.write(''.join([self._record(data, timestamp, port)
+                                   for (data, timestamp, port) in records]))
+
+    def _record(self, data, timestamp, port):
         ppi_len = PPIPktHeader.size + PPIAggregateField.size
-        self.stream.write(PcapPktHeader.pack(
-            int(timestamp), # timestamp seconds
-            int((timestamp - int(timestamp)) * 10**6), # timestamp microseconds
-            len(data) + ppi_len, # truncated length
-            len(data) + ppi_len # un-truncated length
-        ))
-        self.stream.write(PPIPktHeader.pack(
-            0, # version
-            0, # flags
-            ppi_len, # length
-            1, # ethernet dlt
-        ))
-        self.stream.write(PPIAggregateField.pack(8, PPIAggregateField.size - 4, port))
-        self.stream.write(data)
+        return ''.join([
+            PcapPktHeader.pack(
+                int(timestamp), # timestamp seconds
+                int((timestamp - int(timestamp)) * 10**6), # timestamp microseconds
+                len(data) + ppi_len, # truncated length
+                len(data) + ppi_len # un-truncated length
+            ),
+            PPIPktHeader.pack(
+                0, # version
+                0, # flags
+                ppi_len, # length
+                1, # ethernet dlt
+            ),
+            PPIAggregateField.pack(8, PPIAggregateField.size - 4, port),
+            data])
 
     def close(self):
         self.stream.close()
 
+def ip_checksum(header):
+    """
+    Compute the IPv4 header checksum of a string
+    """
+    total = sum(struct.unpack("!%dH" % (len(header) // 2), header))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+class TcpStream(object):
+    """
+    Synthesized framing for one TCP connection
+
+    Keeps the sequence numbers of both directions so that the segments
+    form a valid stream.  Only data segments are produced; Wireshark
+    picks up the stream without the handshake.  TCP checksums are left
+    as zero.
+    """
+
+    def __init__(self, local, remote):
+        """
+        @param local The (ip, port) address of the controller side
+        @param remote The (ip, port) address of the switch side
+        """
+        self.local = self._addr(local, CAPTURE_LOCAL_ADDR)
+        self.remote = self._addr(remote, CAPTURE_REMOTE_ADDR)
+        self.seq = { True: 1, False: 1 } # Next sequence number by direction
+        self.ip_id = 0
+
+    @staticmethod
+    def _addr(addr, default):
+        try:
+            return (socket.inet_aton(addr[0]), int(addr[1]))
+        except (TypeError, ValueError, IndexError, socket.error):
+            return (socket.inet_aton(default[0]), default[1])
+
+    def frames(self, data, outbound):
+        """
+        Frame stream data
+
+        @param data The bytes sent in one direction
+        @param outbound True if sent by the controller
+        @returns A list of Ethernet frames
+        """
+        if outbound:
+            src, dst = self.local, self.remote
+            eth = EthernetHeader.pack(CAPTURE_REMOTE_MAC, CAPTURE_LOCAL_MAC,
+                                      0x0800)
+        else:
+            src, dst = self.remote, self.local
+            eth = EthernetHeader.pack(CAPTURE_LOCAL_MAC, CAPTURE_REMOTE_MAC,
+                                      0x0800)
+
+        result = []
+        for offset in range(0, len(data), TCP_SEGMENT_SIZE):
+            payload = data[offset:offset + TCP_SEGMENT_SIZE]
+            tcp = TCPHeader.pack(src[1], dst[1],
+                                 self.seq[outbound] & 0xffffffff,
+                                 self.seq[not outbound] & 0xffffffff,
+                                 TCPHeader.size << 2, # data offset
+                                 0x18, # PSH, ACK
+                                 65535, # window
+                                 0, # checksum
+                                 0) # urgent pointer
+            self.seq[outbound] += len(payload)
+            self.ip_id = (self.ip_id + 1) & 0xffff
+            ip_len = IPv4Header.size + len(tcp) + len(payload)
+            ip = IPv4Header.pack(0x45, 0, ip_len, self.ip_id, 0x4000, 64,
+                                 socket.IPPROTO_TCP, 0, src[0], dst[0])
+            ip = ip[:10] + struct.pack("!H", ip_checksum(ip)) + ip[12:]
+            result.append(eth + ip + tcp + payload)
+        return result
+
+class ControlCapture(object):
+    """
+    Capture of OpenFlow control channel messages to a pcap file
+
+    Messages are handed to a background thread through a bounded queue,
+    so capturing does not slow down the controller.  If the queue is
+    full the message is not captured and counted in dropped.
+
+    @var dropped Number of messages not captured because the queue was full
+    """
+
+    def __init__(self, filename, queue_size=CAPTURE_QUEUE_SIZE):
+        self.writer = PcapWriter(filename)
+        self.queue = Queue.Queue(queue_size)
+        self.dropped = 0
+        self.logger = logging.getLogger("controller")
+        self.thread = Thread(target=self._run, name="capture")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def message(self, cxn_id, local, remote, data, outbound):
+        """
+        Capture a message
+
+        @param cxn_id Number of the connection, recorded as the PPI port
+        @param local The (ip, port) address of the controller side
+        @param remote The (ip, port) address of the switch side
+        @param data The packed message
+        @param outbound True if sent by the controller
+        """
+        try:
+            self.queue.put_nowait((time.time(), cxn_id, local, remote,
+                                   data, outbound))
+        except Queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """
+        Write the queued messages and close the file
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.dropped:
+            self.logger.warn("Control capture dropped %d messages", self.dropped)
+
+    def _run(self):
+        streams = {}
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            timestamp, cxn_id, local, remote, data, outbound = item
+            stream = streams.get((cxn_id, local, remote))
+            if stream is None:
+                stream = streams[(cxn_id, local, remote)] = \
+                    TcpStream(local, remote)
+            for frame in stream.frames(data, outbound):
+                self.writer.write(frame, timestamp, cxn_id)
+
 if __name__ == "__main__":
     import time
     print("Writing test pcap to test.pcap")
@@ -0,0 +1,142 @@
+"""
+Event loop support for the controller and dataplane threads
+
+A reactor holds a set of registered objects, each providing fileno(), and
+waits for any of them to become readable.  Objects are registered once
+when their socket is created and unregistered before it is closed, so the
+event loop does not rebuild its descriptor list on every iteration.
+
+Two implementations are provided: EpollReactor on Linux, and
+SelectReactor as the portable fallback.  DefaultReactor names the best
+one available on this platform.
+"""
+
+import select
+import errno
+
+class SelectReactor(object):
+    """
+    Reactor implemented with select(2)
+
+    Limited to FD_SETSIZE descriptors.
+    """
+
+    def __init__(self):
+        self.objs = {}
+        self.objs_list = []
+
+    def register(self, obj):
+        """
+        Start waiting for obj to become readable
+        """
+        self.objs[obj.fileno()] = obj
+        self.objs_list = self.objs.values()
+
+    def unregister(self, obj):
+        """
+        Stop waiting on obj
+
+        Must be called before the underlying descriptor is closed.
+        """
+        for fd, registered in self.objs.items():
+            if registered is obj:
+                del self.objs[fd]
+        self.objs_list = self.objs.values()
+
+    def poll(self, timeout=None):
+        """
+        Wait for registered objects to become ready
+
+        @param timeout Maximum number of seconds to wait, or None to wait
+        until an object is ready
+        @returns A pair (readable, errored) of lists of registered objects
+        """
+        objs = self.objs_list
+        try:
+            sel_in, sel_out, sel_err = select.select(objs, [], objs, timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return ([], [])
+            raise
+        return (sel_in, sel_err)
+
+    def close(self):
+        self.objs = {}
+        self.objs_list = []
+
+class EpollReactor(object):
+    """
+    Reactor implemented with Linux epoll(7)
+
+    Registration is done once per object and the kernel keeps the
+    interest list, so the cost of a wakeup does not depend on the number
+    of registered objects.
+    """
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.objs = {}
+
+    def register(self, obj):
+        """
+        Start waiting for obj to become readable
+        """
+        fd = obj.fileno()
+        self.objs[fd] = obj
+        self.epoll.register(fd, select.EPOLLIN | select.EPOLLPRI)
+
+    def unregister(self, obj):
+        """
+        Stop waiting on obj
+
+        Must be called before the underlying descriptor is closed.
+        """
+        for fd, registered in self.objs.items():
+            if registered is obj:
+                del self.objs[fd]
+                try:
+                    self.epoll.unregister(fd)
+                except (IOError, OSError, ValueError):
+                    # Already closed
+                    pass
+
+    def poll(self, timeout=None):
+        """
+        Wait for registered objects to become ready
+
+        Hangups are reported as readable so that the subsequent read sees
+        end of file.
+
+        @param timeout Maximum number of seconds to wait, or None to wait
+        until an object is ready
+        @returns A pair (readable, errored) of lists of registered objects
+        """
+        if timeout is None:
+            timeout = -1
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError as e:
+            if e.errno == errno.EINTR:
+                return ([], [])
+            raise
+
+        readable = []
+        errored = []
+        for fd, event in events:
+            obj = self.objs.get(fd)
+            if obj is None:
+                continue
+            if event & select.EPOLLERR:
+                errored.append(obj)
+            else:
+                readable.append(obj)
+        return (readable, errored)
+
+    def close(self):
+        self.epoll.close()
+        self.objs = {}
+
+if hasattr(select, "epoll"):
+    DefaultReactor = EpollReactor
+else:
+    DefaultReactor = SelectReactor
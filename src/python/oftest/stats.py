@@ -0,0 +1,265 @@
+"""
+Control channel statistics
+
+Each controller Connection keeps a MessageStats object counting the
+messages and bytes sent and received per OpenFlow message type, the
+error messages received per (type, code), the high-water mark of its
+message queue and the messages dropped from it per type, and latency
+histograms for transactions.
+
+Two latencies are recorded for each transaction, keyed by the type of
+the request:
+
+  rtt: From writing the request to the controller thread matching the
+  reply.  This is dominated by the switch and the network.
+
+  transact: From the call to Connection.transact to its return.  The
+  difference from rtt is framework overhead (packing, thread wakeup).
+"""
+
+import logging
+from threading import Lock
+
+# Upper bounds of the histogram buckets, in seconds: 10us doubling up to
+# about 84s.  Larger values go in a final overflow bucket.
+HISTOGRAM_BOUNDS = [0.00001 * 2 ** i for i in range(24)]
+
+class Histogram(object):
+    """
+    Latency histogram with exponential buckets
+
+    @var counts Number of samples in each bucket; the last entry counts
+    samples above the largest bound
+    @var count Total number of samples
+    @var total Sum of all samples, in seconds
+    @var min Smallest sample, or None
+    @var max Largest sample, or None
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def record(self, value):
+        """
+        Add a sample
+
+        @param value The latency in seconds
+        """
+        idx = 0
+        for bound in HISTOGRAM_BOUNDS:
+            if value <= bound:
+                break
+            idx += 1
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Add the samples of another histogram to this one
+        """
+        for idx, count in enumerate(other.counts):
+            self.counts[idx] += count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def percentile(self, pct):
+        """
+        Estimate a percentile
+
+        @param pct The percentile, from 0 to 100
+        @returns The upper bound of the bucket holding the percentile, in
+        seconds, or None if there are no samples
+        """
+        if self.count == 0:
+            return None
+        target = self.count * pct / 100.0
+        seen = 0
+        for idx, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                if idx < len(HISTOGRAM_BOUNDS):
+                    return min(HISTOGRAM_BOUNDS[idx], self.max)
+                return self.max
+        return self.max
+
+    def mean(self):
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+    def __str__(self):
+        if self.count == 0:
+            return "count 0"
+        return "count %d min %.6f mean %.6f p50 %.6f p99 %.6f max %.6f" % \
+            (self.count, self.min, self.mean(), self.percentile(50),
+             self.percentile(99), self.max)
+
+class MessageStats(object):
+    """
+    Message counters and latency histograms for one connection
+
+    Counters are dicts keyed by OpenFlow message type number.  All
+    updates are made under a lock since the receive thread, senders and
+    transaction waiters record concurrently.
+
+    @var rx_count Messages received per type
+    @var rx_bytes Bytes received per type
+    @var tx_count Messages sent per type
+    @var tx_bytes Bytes sent per type
+    @var queue_high Largest length of the message queue
+    @var drops Messages dropped from the full message queue per type
+    @var errors Error messages received per (type, code)
+    @var stale Replies received for requests that had already timed out
+    @var rtt Dict from request type to Histogram of request to reply times
+    @var transact Dict from request type to Histogram of transact call times
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.rx_count = {}
+            self.rx_bytes = {}
+            self.tx_count = {}
+            self.tx_bytes = {}
+            self.queue_high = 0
+            self.drops = {}
+            self.errors = {}
+            self.stale = 0
+            self.rtt = {}
+            self.transact = {}
+
+    def rx(self, msg_type, length):
+        with self.lock:
+            self.rx_count[msg_type] = self.rx_count.get(msg_type, 0) + 1
+            self.rx_bytes[msg_type] = self.rx_bytes.get(msg_type, 0) + length
+
+    def tx(self, msg_type, length):
+        with self.lock:
+            self.tx_count[msg_type] = self.tx_count.get(msg_type, 0) + 1
+            self.tx_bytes[msg_type] = self.tx_bytes.get(msg_type, 0) + length
+
+    def drop(self, msg_type):
+        with self.lock:
+            self.drops[msg_type] = self.drops.get(msg_type, 0) + 1
+
+    def stale_reply(self):
+        with self.lock:
+            self.stale += 1
+
+    def error(self, err_type, code):
+        """
+        Count an error message
+
+        @returns The number of errors of this type and code so far
+        """
+        with self.lock:
+            key = (err_type, code)
+            count = self.errors.get(key, 0) + 1
+            self.errors[key] = count
+        return count
+
+    def queue_len(self, length):
+        if length > self.queue_high:
+            self.queue_high = length
+
+    def rtt_record(self, msg_type, elapsed):
+        with self.lock:
+            if msg_type not in self.rtt:
+                self.rtt[msg_type] = Histogram()
+            self.rtt[msg_type].record(elapsed)
+
+    def transact_record(self, msg_type, elapsed):
+        with self.lock:
+            if msg_type not in self.transact:
+                self.transact[msg_type] = Histogram()
+            self.transact[msg_type].record(elapsed)
+
+    def merge(self, other):
+        """
+        Add the counters and histograms of another MessageStats
+        """
+        with self.lock:
+            for mine, theirs in [(self.rx_count, other.rx_count),
+                                 (self.rx_bytes, other.rx_bytes),
+                                 (self.tx_count, other.tx_count),
+                                 (self.tx_bytes, other.tx_bytes),
+                                 (self.drops, other.drops),
+                                 (self.errors, other.errors)]:
+                for msg_type, value in theirs.items():
+                    mine[msg_type] = mine.get(msg_type, 0) + value
+            self.queue_high = max(self.queue_high, other.queue_high)
+            self.stale += other.stale
+            for mine, theirs in [(self.rtt, other.rtt),
+                                 (self.transact, other.transact)]:
+                for msg_type, hist in theirs.items():
+                    if msg_type not in mine:
+                        mine[msg_type] = Histogram()
+                    mine[msg_type].merge(hist)
+
+    def lines(self, type_map=None):
+        """
+        Format the statistics, one item per line
+
+        @param type_map Optional dict from message type number to name,
+        such as ofp.ofp_type_map
+        @returns A list of strings
+        """
+        def name(msg_type):
+            if type_map and msg_type in type_map:
+                return type_map[msg_type]
+            return str(msg_type)
+
+        result = []
+        with self.lock:
+            for msg_type in sorted(set(self.rx_count) | set(self.tx_count)):
+                result.append("%s rx %d msgs %d bytes tx %d msgs %d bytes" %
+                              (name(msg_type),
+                               self.rx_count.get(msg_type, 0),
+                               self.rx_bytes.get(msg_type, 0),
+                               self.tx_count.get(msg_type, 0),
+                               self.tx_bytes.get(msg_type, 0)))
+            result.append("queue high-water %d" % self.queue_high)
+            for msg_type, count in sorted(self.drops.items()):
+                result.append("%s queue drops %d" % (name(msg_type), count))
+            if self.stale:
+                result.append("stale replies %d" % self.stale)
+            for (err_type, code), count in sorted(self.errors.items()):
+                result.append("error type %d code %d count %d" %
+                              (err_type, code, count))
+            for msg_type, hist in sorted(self.rtt.items()):
+                result.append("%s rtt %s" % (name(msg_type), hist))
+            for msg_type, hist in sorted(self.transact.items()):
+                result.append("%s transact %s" % (name(msg_type), hist))
+        return result
+
+    def dump(self, logger=None, type_map=None, prefix="", level=logging.INFO):
+        """
+        Log the statistics
+
+        @param logger The logger to use; the root logger by default
+        @param type_map See lines()
+        @param prefix String put in front of each line
+        @param level The logging level
+        """
+        if logger is None:
+            logger = logging.getLogger()
+        if not logger.isEnabledFor(level):
+            return
+        for line in self.lines(type_map):
+            logger.log(level, "%s%s", prefix, line)
@@ -0,0 +1,488 @@
+#!/usr/bin/env python
+"""
+Controller unit tests
+
+The controller is connected to a fake switch over an in-process socketpair,
+so these tests run without a switch or the TCP stack.
+"""
+import sys
+import time
+import struct
+import socket
+import unittest
+
+import loxi
+import loxi.of13 as ofp
+# oft installs the configured OpenFlow version as the "ofp" module
+sys.modules.setdefault("ofp", ofp)
+
+import ofutils
+import controller
+import transport
+
+ofutils.default_timeout = 2
+
+TIMEOUT = 2
+
+class ControllerTest(unittest.TestCase):
+    """
+    Runs a Controller whose only connection goes to a fake switch
+
+    The switch end of the socketpair is self.switch.  Subclasses may set
+    controller_args to pass arguments to the Controller.
+    """
+
+    controller_args = {}
+
+    def setUp(self):
+        self.transport = transport.SocketpairTransport()
+        self.controller = controller.Controller(transport=self.transport,
+                                                **self.controller_args)
+        self.controller.initial_hello = False
+        self.controller.start()
+        self.assertTrue(self.controller.connect(timeout=TIMEOUT))
+        self.switch = self.transport.peer
+        self.switch.settimeout(TIMEOUT)
+
+    def tearDown(self):
+        self.controller.kill()
+        self.switch.close()
+
+    def switch_send(self, *msgs):
+        self.switch.sendall(''.join(
+            msg if isinstance(msg, str) else msg.pack() for msg in msgs))
+
+    def switch_recv(self):
+        """
+        Read one message sent by the controller
+        """
+        buf = ''
+        while len(buf) < 8 or len(buf) < struct.unpack("!H", buf[2:4])[0]:
+            data = self.switch.recv(65536 if len(buf) >= 8 else 8 - len(buf))
+            self.assertTrue(data, "controller closed the connection")
+            buf += data
+        return ofp.message.parse_message(buf)
+
+    def switch_send_sync(self, *msgs):
+        """
+        Send messages from the switch and wait until the controller has
+        processed them, using an echo transaction completed after them
+        """
+        trans = self.controller.transact_async(ofp.message.echo_request())
+        req = self.switch_recv()
+        self.assertEquals(req.type, ofp.OFPT_ECHO_REQUEST)
+        self.switch_send(*(msgs + (ofp.message.echo_reply(xid=req.xid),)))
+        reply, _ = trans.wait(timeout=TIMEOUT)
+        self.assertTrue(reply is not None, "sync echo not answered")
+
+    def queued(self):
+        with self.controller.packets_cv:
+            return [msg for msg, _ in self.controller.packets]
+
+def packet_in(buffer_id, data='x' * 20, in_port=1):
+    return ofp.message.packet_in(
+        xid=buffer_id + 1, buffer_id=buffer_id, reason=ofp.OFPR_NO_MATCH,
+        match=ofp.match([ofp.oxm.in_port(in_port)]), data=data)
+
+def flow_removed(cookie, xid=0):
+    return ofp.message.flow_removed(xid=xid, cookie=cookie,
+                                    match=ofp.match([]))
+
+def port_status(xid):
+    return ofp.message.port_status(xid=xid, reason=ofp.OFPPR_MODIFY,
+                                   desc=ofp.port_desc(port_no=1))
+
+class TestTransactions(ControllerTest):
+    def test_pipelined(self):
+        transactions = [self.controller.transact_async(
+                            ofp.message.barrier_request()) for i in range(3)]
+        requests = [self.switch_recv() for i in range(3)]
+        self.assertEquals([r.xid for r in requests],
+                          [t.xid for t in transactions])
+        # Replies arrive in the opposite order
+        self.switch_send(*[ofp.message.barrier_reply(xid=r.xid)
+                           for r in reversed(requests)])
+        for trans in transactions:
+            reply, _ = trans.wait(timeout=TIMEOUT)
+            self.assertEquals(reply.xid, trans.xid)
+        self.assertEquals(self.queued(), [])
+
+    def test_xid_outstanding(self):
+        trans = self.controller.transact_async(
+            ofp.message.echo_request(xid=1234))
+        self.assertTrue(trans is not None)
+        self.assertEquals(self.controller.transact_async(
+            ofp.message.echo_request(xid=1234)), None)
+        self.switch_recv()
+        self.switch_send(ofp.message.echo_reply(xid=1234))
+        self.assertEquals(trans.wait(timeout=TIMEOUT)[0].xid, 1234)
+
+        # The xid may be used again once the reply has arrived
+        trans = self.controller.transact_async(
+            ofp.message.echo_request(xid=1234))
+        self.assertTrue(trans is not None)
+        self.switch_recv()
+        self.switch_send(ofp.message.echo_reply(xid=1234))
+        self.assertEquals(trans.wait(timeout=TIMEOUT)[0].xid, 1234)
+
+    def test_rtt_recorded(self):
+        self.controller.cork()
+        trans = self.controller.transact_async(ofp.message.barrier_request())
+        time.sleep(0.2)
+        self.controller.uncork()
+        req = self.switch_recv()
+        self.switch_send(ofp.message.barrier_reply(xid=req.xid))
+        trans.wait(timeout=TIMEOUT)
+        rtt = self.controller.stats_get().rtt[ofp.OFPT_BARRIER_REQUEST]
+        self.assertEquals(rtt.count, 1)
+        # The time spent corked is not part of the round trip
+        self.assertTrue(rtt.max < 0.2)
+
+    def test_stale_reply(self):
+        trans = self.controller.transact_async(ofp.message.barrier_request())
+        req = self.switch_recv()
+        self.assertEquals(trans.wait(timeout=0.1), (None, None))
+        self.switch_send_sync(ofp.message.barrier_reply(xid=req.xid))
+        self.assertEquals(self.controller.stats_get().stale, 1)
+
+class TestXidAllocator(unittest.TestCase):
+    def test_skip_outstanding(self):
+        xids = ofutils.XidAllocator()
+        xids.next_xid = ofutils.XID_MAX
+        self.assertTrue(xids.reserve(1))
+        self.assertFalse(xids.reserve(1))
+        self.assertEquals(xids.next(), ofutils.XID_MAX)
+        # Wraps past 0 and skips the outstanding xid
+        self.assertEquals(xids.next(), 2)
+
+    def test_stale(self):
+        xids = ofutils.XidAllocator()
+        xids.reserve(5)
+        xids.release(5, expired=True)
+        self.assertTrue(xids.stale(5))
+        self.assertTrue(xids.reserve(5))
+        self.assertFalse(xids.stale(5))
+
+class TestMessageQueue(unittest.TestCase):
+    def setUp(self):
+        self.queue = controller.MessageQueue()
+
+    def append(self, *msgs, **kwargs):
+        for msg in msgs:
+            self.queue.append(msg, msg.pack(), **kwargs)
+
+    def test_out_of_order(self):
+        self.queue.append(port_status(1), None, seq=1)
+        self.queue.append(port_status(3), None, seq=3)
+        self.queue.append(flow_removed(0, xid=4), None, seq=4)
+        # A message passed on late by a dispatch worker
+        self.queue.append(port_status(2), None, seq=2)
+        self.assertEquals([m.xid for m, _ in self.queue], [1, 2, 3, 4])
+        self.assertEquals(self.queue.grab(ofp.message.port_status)[0].xid, 1)
+        self.assertEquals(self.queue.grab(ofp.message.port_status)[0].xid, 2)
+        # Without a sequence number messages go to the tail
+        self.queue.append(port_status(5), None)
+        self.assertEquals([m.xid for m, _ in self.queue], [3, 4, 5])
+
+    def test_pop(self):
+        self.append(port_status(1), flow_removed(0, xid=2))
+        self.assertEquals(self.queue.pop()[0].xid, 1)
+        self.assertEquals(self.queue.pop(0)[0].xid, 2)
+        self.assertRaises(IndexError, self.queue.pop)
+        self.append(port_status(3), port_status(4))
+        self.assertRaises(IndexError, self.queue.pop, 1)
+
+    def test_grab(self):
+        self.append(port_status(1), flow_removed(0, xid=2), port_status(3),
+                    ofp.message.barrier_reply(xid=4))
+        self.assertEquals(self.queue.grab(ofp.message.flow_removed)[0].xid, 2)
+        self.assertEquals(self.queue.grab(ofp.message.flow_removed), None)
+        self.assertEquals(self.queue.grab()[0].xid, 1)
+        self.assertEquals(self.queue.grab(ofp.message.barrier_reply)[0].xid,
+                          4)
+        self.assertEquals([m.xid for m, _ in self.queue], [3])
+        self.assertEquals(self.queue.grab()[0].xid, 3)
+        self.assertEquals(self.queue.grab(), None)
+
+    def test_grab_abstract(self):
+        self.append(port_status(1), ofp.message.barrier_reply(xid=2),
+                    ofp.message.flow_stats_reply(xid=3))
+        self.assertEquals(self.queue.grab(ofp.message.stats_reply)[0].xid, 3)
+        self.assertEquals(self.queue.grab(ofp.message.message)[0].xid, 1)
+
+    def test_len(self):
+        self.queue.quotas[ofp.OFPT_PACKET_IN] = 2
+        self.append(*[packet_in(i) for i in range(3)])
+        self.assertEquals(self.queue.append(packet_in(3), None),
+                          ofp.OFPT_PACKET_IN)
+        self.append(port_status(10), port_status(11), limit=2)
+        self.assertEquals(len(self.queue), 4)
+        self.assertEquals(self.queue.append(port_status(12), None, limit=2),
+                          ofp.OFPT_PORT_STATUS)
+        self.assertEquals(len(self.queue), 4)
+        self.assertEquals([m.xid for m, _ in self.queue], [3, 4, 11, 12])
+        self.queue.grab(ofp.message.port_status)
+        self.assertEquals(len(self.queue), 3)
+        self.queue.clear()
+        self.assertEquals(len(self.queue), 0)
+        self.assertFalse(self.queue)
+
+    def test_undecodable(self):
+        errors = []
+        self.queue.on_parse_error = lambda: errors.append(None)
+        truncated = struct.pack("!BBHL", 4, ofp.OFPT_PORT_STATUS, 8, 1)
+        for pkt in (truncated, port_status(2).pack()):
+            self.queue.append(controller.LazyMessage(
+                pkt, 4, ofp.OFPT_PORT_STATUS, struct.unpack("!L", pkt[4:8])[0]),
+                pkt)
+        self.assertEquals(self.queue.pop()[0].xid, 2)
+        self.assertEquals(len(errors), 1)
+        self.assertEquals(len(self.queue), 0)
+
+class TestLazyDecode(ControllerTest):
+    def test_undecodable_removed(self):
+        truncated = struct.pack("!BBHL", 4, ofp.OFPT_PORT_STATUS, 8, 7)
+        self.switch_send_sync(truncated, port_status(8))
+        msg, _ = self.controller.poll(ofp.message.port_status, timeout=0)
+        self.assertEquals(msg.xid, 8)
+        self.assertEquals(self.controller.parse_errors, 1)
+        self.assertEquals(len(self.controller.packets), 0)
+
+    def test_decode_on_demand(self):
+        self.switch_send_sync(port_status(3))
+        with self.controller.packets_cv:
+            entry = self.controller.packets.order[0][0]
+        self.assertTrue(isinstance(entry, controller.LazyMessage))
+        self.assertFalse(entry.decoded)
+        msg, _ = self.controller.poll(ofp.message.port_status, timeout=0)
+        self.assertTrue(isinstance(msg, ofp.message.port_status))
+
+class TestEcho(ControllerTest):
+    def test_echo_reply(self):
+        self.controller.keep_alive = True
+        self.switch_send(ofp.message.echo_request(xid=77, data='abc'))
+        reply = self.switch_recv()
+        self.assertEquals(reply.type, ofp.OFPT_ECHO_REPLY)
+        self.assertEquals((reply.xid, reply.data), (77, 'abc'))
+        self.assertEquals(len(self.controller.packets), 0)
+
+    def test_echo_leaves_cork(self):
+        self.controller.keep_alive = True
+        self.controller.cork()
+        self.controller.message_send(ofp.message.hello(xid=5))
+        self.switch_send(ofp.message.echo_request(xid=78))
+        self.assertEquals(self.switch_recv().xid, 78)
+        self.controller.uncork()
+        self.assertEquals(self.switch_recv().xid, 5)
+
+    def test_no_keep_alive(self):
+        self.switch_send_sync(ofp.message.echo_request(xid=79))
+        msg, _ = self.controller.poll(ofp.message.echo_request, timeout=0)
+        self.assertEquals(msg.xid, 79)
+
+class TestPacketInFilter(ControllerTest):
+    def setUp(self):
+        ControllerTest.setUp(self)
+        self.controller.filter_packet_in = True
+        self.controller.pkt_in_filter_limit = 3
+        self.controller.pkt_in_filter_rate = 0
+
+    def test_limit(self):
+        self.switch_send_sync(*[packet_in(i) for i in range(10)])
+        self.assertEquals([m.buffer_id for m in self.queued()], [0, 1, 2])
+        self.assertEquals(self.controller.pkt_in_dropped, 7)
+
+    def test_per_port(self):
+        self.switch_send_sync(*[packet_in(i, in_port=1 + i % 2)
+                                for i in range(10)])
+        self.assertEquals(len(self.queued()), 6)
+        self.assertEquals(self.controller.pkt_in_dropped, 4)
+
+    def test_sample(self):
+        self.controller.pkt_in_sample = 2
+        self.switch_send_sync(*[packet_in(i) for i in range(10)])
+        self.assertEquals([m.buffer_id for m in self.queued()],
+                          [0, 1, 2, 4, 6, 8])
+
+    def test_expected(self):
+        self.controller.pkt_in_expect('expected payload')
+        self.switch_send_sync(*[packet_in(i) for i in range(5)] +
+                              [packet_in(i, data='expected payload')
+                               for i in range(5, 7)])
+        self.assertEquals([m.buffer_id for m in self.queued()],
+                          [0, 1, 2, 5, 6])
+        self.assertEquals(self.controller.pkt_in_dropped, 2)
+
+class TestMultipart(ControllerTest):
+    def reply(self, xid, cookie, more):
+        return ofp.message.flow_stats_reply(
+            xid=xid, flags=more and ofp.OFPSF_REPLY_MORE or 0,
+            entries=[ofp.flow_stats_entry(cookie=cookie)])
+
+    def test_more(self):
+        stream = self.controller.multipart(ofp.message.flow_stats_request())
+        req = self.switch_recv()
+        self.switch_send(self.reply(req.xid, 1, True),
+                         self.reply(req.xid, 2, True),
+                         self.reply(req.xid, 3, False),
+                         self.reply(req.xid, 4, False))
+        cookies = [msg.entries[0].cookie for msg, _ in stream]
+        stream.close()
+        self.assertEquals(cookies, [1, 2, 3])
+        self.assertFalse(stream.timed_out or stream.parse_error)
+        # A reply after the last one is not part of the stream
+        msg, _ = self.controller.poll(ofp.message.flow_stats_reply,
+                                      timeout=TIMEOUT)
+        self.assertEquals(msg.entries[0].cookie, 4)
+
+    def test_undecodable(self):
+        stream = self.controller.multipart(ofp.message.flow_stats_request())
+        req = self.switch_recv()
+        bad = self.reply(req.xid, 2, True).pack()
+        bad = bad[:2] + struct.pack("!H", len(bad) - 8) + bad[4:-8]
+        self.switch_send(self.reply(req.xid, 1, True), bad,
+                         self.reply(req.xid, 3, False))
+        cookies = [msg.entries[0].cookie for msg, _ in stream]
+        stream.close()
+        self.assertEquals(cookies, [1])
+        self.assertTrue(stream.parse_error)
+
+    def test_timeout(self):
+        stream = self.controller.multipart(ofp.message.flow_stats_request())
+        stream.timeout = 0.1
+        req = self.switch_recv()
+        self.switch_send(self.reply(req.xid, 1, True))
+        self.assertEquals(len(list(stream)), 1)
+        self.assertTrue(stream.timed_out)
+
+class TestQueueBounds(ControllerTest):
+    def test_quota(self):
+        self.controller.queue_quotas[ofp.OFPT_PACKET_IN] = 2
+        self.switch_send_sync(*[packet_in(i) for i in range(5)])
+        self.assertEquals([m.buffer_id for m in self.queued()], [3, 4])
+        self.assertEquals(self.controller.stats_get().drops,
+                          {ofp.OFPT_PACKET_IN: 3})
+
+    def test_priority(self):
+        self.controller.max_pkts = 3
+        # A reply evicts the oldest asynchronous message
+        self.switch_send_sync(flow_removed(1), flow_removed(2),
+                              ofp.message.barrier_reply(xid=9),
+                              ofp.message.barrier_reply(xid=10))
+        self.assertEquals([m.xid for m in self.queued()], [0, 9, 10])
+        # An asynchronous message only evicts another one
+        self.switch_send_sync(flow_removed(3))
+        self.assertEquals([getattr(m, "cookie", None) for m in self.queued()],
+                          [None, None, 3])
+        # With only replies queued a new asynchronous message is dropped
+        self.switch_send_sync(ofp.message.barrier_reply(xid=11),
+                              flow_removed(4))
+        self.assertEquals([m.xid for m in self.queued()], [9, 10, 11])
+        self.assertEquals(self.controller.stats_get().drops,
+                          {ofp.OFPT_FLOW_REMOVED: 4})
+
+class TestEventStreams(ControllerTest):
+    def test_cookie_filter(self):
+        stream = self.controller.flow_removed_stream(
+            controller.cookie_range(1, 10))
+        self.switch_send_sync(flow_removed(5), flow_removed(50),
+                              flow_removed(10))
+        self.assertEquals(stream.get(timeout=0)[0].cookie, 5)
+        self.assertEquals(stream.get(timeout=0)[0].cookie, 10)
+        self.assertEquals(len(stream), 0)
+        # Messages rejected by every filter are queued as usual
+        self.assertEquals([m.cookie for m in self.queued()], [50])
+        stream.close()
+        self.switch_send_sync(flow_removed(6))
+        self.assertEquals([m.cookie for m in self.queued()], [50, 6])
+
+    def test_callback(self):
+        events = []
+        stream = self.controller.port_status_stream(
+            callback=lambda msg, pkt: events.append(msg.xid))
+        self.switch_send_sync(port_status(1), port_status(2))
+        self.assertEquals(events, [1, 2])
+        self.assertEquals(stream.received, 2)
+
+    def test_callback_error(self):
+        def callback(msg, pkt):
+            raise ValueError("callback failed")
+        self.controller.port_status_stream(callback=callback)
+        self.switch_send_sync(port_status(1))
+        self.assertEquals(self.controller.cxn.errors, 1)
+        self.assertTrue(self.controller.is_alive())
+
+class TestDispatch(ControllerTest):
+    controller_args = dict(dispatch_workers=1)
+
+    def test_wire_order(self):
+        def handler(cxn, msg, pkt):
+            time.sleep(0.01)
+            # Decline odd buffer ids
+            return msg.buffer_id % 2 == 0
+        self.controller.register(ofp.OFPT_PACKET_IN, handler)
+        msgs = []
+        for i in range(3):
+            msgs += [packet_in(2 * i), packet_in(2 * i + 1),
+                     port_status(100 + i)]
+        self.switch_send_sync(*msgs)
+        self.assertTrue(self.controller.cxn.dispatch_wait(timeout=TIMEOUT))
+        self.assertEquals([m.xid for m in self.queued()],
+                          [2, 100, 4, 101, 6, 102])
+
+class TestDispatchBounded(ControllerTest):
+    controller_args = dict(dispatch_workers=1, dispatch_queue_size=4)
+
+    def test_data_dropped(self):
+        def handler(cxn, msg, pkt):
+            time.sleep(0.01)
+            return True
+        self.controller.register(ofp.OFPT_PACKET_IN, handler)
+        self.controller.register(ofp.OFPT_FLOW_REMOVED, handler)
+        self.switch_send_sync(*[packet_in(i) for i in range(20)] +
+                              [flow_removed(i) for i in range(10)] +
+                              [port_status(100)])
+        msg, _ = self.controller.poll(ofp.message.port_status, timeout=0)
+        self.assertEquals(msg.xid, 100)
+        self.assertTrue(self.controller.cxn.dispatch_wait(timeout=TIMEOUT))
+        drops = self.controller.stats_get().drops
+        self.assertEquals(drops.keys(), [ofp.OFPT_PACKET_IN])
+        self.assertEquals(self.controller.packets_handled,
+                          30 - drops[ofp.OFPT_PACKET_IN])
+
+class TestInlineHandler(ControllerTest):
+    def test_handler_error(self):
+        def handler(cxn, msg, pkt):
+            raise ValueError("handler failed")
+        self.controller.register(ofp.OFPT_PORT_STATUS, handler)
+        self.switch_send_sync(port_status(1))
+        self.assertEquals(self.controller.cxn.errors, 1)
+        self.assertTrue(self.controller.is_alive())
+
+class TestReset(ControllerTest):
+    def setUp(self):
+        ControllerTest.setUp(self)
+        self.saved_timeout = controller.RESET_BARRIER_TIMEOUT
+        controller.RESET_BARRIER_TIMEOUT = 0.2
+
+    def tearDown(self):
+        controller.RESET_BARRIER_TIMEOUT = self.saved_timeout
+        ControllerTest.tearDown(self)
+
+    def test_reset(self):
+        self.controller.filter_packet_in = True
+        self.controller.pkt_in_filter_limit = 1
+        self.switch_send_sync(port_status(1))
+        self.assertTrue(self.controller.reset())
+        self.assertEquals(self.switch_recv().type, ofp.OFPT_BARRIER_REQUEST)
+        self.assertEquals(self.queued(), [])
+        self.assertFalse(self.controller.filter_packet_in)
+        self.assertEquals(self.controller.pkt_in_filter_limit,
+                          controller.PKT_IN_FILTER_LIMIT)
+
+    def test_reset_failed(self):
+        self.controller.cxn.socket.shutdown(socket.SHUT_WR)
+        self.assertFalse(self.controller.reset())
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Dataplane unit tests
+
+The dataplane ports are replaced by datagram socketpairs, so these tests
+run without network interfaces.
+"""
+import time
+import errno
+import socket
+import unittest
+
+import ofutils
+import dataplane
+
+TIMEOUT = 2
+
+class FakePort(object):
+    """
+    Dataplane port reading packets written to the other end of a
+    socketpair
+
+    @var peer The end of the socketpair that injects packets
+    """
+
+    def __init__(self, interface_name, port_number):
+        self.interface_name = interface_name
+        self.port_number = port_number
+        self.socket, self.peer = socket.socketpair(socket.AF_UNIX,
+                                                   socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    def recv_many(self):
+        pkts = []
+        while True:
+            try:
+                pkts.append((self.socket.recv(65536), time.time()))
+            except socket.error as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                return pkts
+
+class DataPlaneTest(unittest.TestCase):
+    def setUp(self):
+        self.dataplane = dataplane.DataPlane(
+            {"dataplane": {"portclass": FakePort}})
+        for port_number in (1, 2, 3):
+            self.dataplane.port_add("fake%d" % port_number, port_number)
+
+    def tearDown(self):
+        self.dataplane.kill()
+
+    def queued(self):
+        return sum(len(q) for q in self.dataplane.packet_queues.values())
+
+    def inject(self, port_number, *pkts):
+        """
+        Receive packets on a port and wait until they are queued or
+        dropped from a full queue
+        """
+        dp = self.dataplane
+        with dp.cvar:
+            expected = self.queued() + \
+                sum(dp.queue_drops.values()) + len(pkts)
+        for pkt in pkts:
+            dp.ports[port_number].peer.send(pkt)
+        with dp.cvar:
+            ok = ofutils.timed_wait(dp.cvar, lambda: self.queued() +
+                sum(dp.queue_drops.values()) >= expected or None,
+                timeout=TIMEOUT)
+        self.assertTrue(ok, "packets not received")
+
+    def poll_all(self, port_number=None):
+        pkts = []
+        while True:
+            (rcv_port_number, pkt, _) = self.dataplane.poll(port_number,
+                                                            timeout=0)
+            if pkt is None:
+                return pkts
+            pkts.append((rcv_port_number, pkt))
+
+    def test_order(self):
+        self.inject(2, "a")
+        self.inject(1, "b", "c")
+        self.inject(3, "d")
+        self.inject(2, "e")
+        self.assertEquals(self.dataplane.oldest_port_number(), 2)
+        self.assertEquals(self.poll_all(),
+                          [(2, "a"), (1, "b"), (1, "c"), (3, "d"), (2, "e")])
+        self.assertEquals(self.dataplane.oldest_port_number(), None)
+
+    def test_order_after_port_poll(self):
+        self.inject(1, "a")
+        self.inject(2, "b")
+        self.inject(1, "c")
+        self.inject(3, "d")
+        self.assertEquals(self.dataplane.poll(1, timeout=0)[1], "a")
+        self.assertEquals(self.dataplane.poll(1, timeout=0)[1], "c")
+        self.assertEquals(self.poll_all(), [(2, "b"), (3, "d")])
+
+    def test_queue_full(self):
+        self.dataplane.queue_len_set(3, 1)
+        self.inject(1, *[str(i) for i in range(5)])
+        self.inject(2, "x")
+        self.assertEquals(self.dataplane.queue_drops[1], 2)
+        self.assertEquals(self.dataplane.queue_high[1], 3)
+        self.assertEquals(self.poll_all(),
+                          [(1, "2"), (1, "3"), (1, "4"), (2, "x")])
+
+    def test_queue_len_shrink(self):
+        self.inject(1, "a", "b", "c")
+        self.inject(2, "d")
+        self.inject(1, "e")
+        self.dataplane.queue_len_set(2, 1)
+        self.assertEquals(self.poll_all(), [(1, "c"), (2, "d"), (1, "e")])
+        # The new depth applies to later packets
+        self.inject(1, "f", "g", "h")
+        self.assertEquals(self.poll_all(), [(1, "g"), (1, "h")])
+
+    def test_queue_len_invalid(self):
+        self.assertRaises(ValueError, self.dataplane.queue_len_set, 0)
+        self.assertRaises(ValueError, self.dataplane.queue_len_set, 0, 1)
+
+    def test_compaction(self):
+        dp = self.dataplane
+        dp.queue_len_set(300)
+        self.inject(1, *[str(i) for i in range(200)])
+        self.inject(2, "x", "y")
+        self.assertEquals([pkt for _, pkt in self.poll_all(1)],
+                          [str(i) for i in range(200)])
+        # Dead entries were dropped from the arrival order
+        self.assertTrue(len(dp.arrivals) < 200)
+        self.assertEquals(len(dp.arrivals) - dp.arrivals_dead, 2)
+        self.assertEquals(self.poll_all(), [(2, "x"), (2, "y")])
+        self.assertEquals(dp.arrivals_dead, 0)
+
+    def test_flush(self):
+        self.dataplane.queue_len_set(1, 1)
+        self.inject(1, "a", "b")
+        self.dataplane.flush()
+        self.assertEquals(self.poll_all(), [])
+        self.assertEquals(self.dataplane.queue_drops[1], 1)
+        self.dataplane.queue_stats_reset()
+        self.assertEquals(self.dataplane.queue_drops[1], 0)
+        self.assertEquals(self.dataplane.queue_high[1], 0)
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -1548,6 +1548,34 @@ def disabled(cls):
     cls._disabled = True
     return cls
 
+def fresh_controller(cls):
+    """
+    Testcase decorator that opts the test out of the session controller.
+    The test gets its own switch connection, so it may change
+    per-connection state such as the controller role or open its own
+    listening socket on the controller port. Tests that check traffic or
+    state from connection setup (the initial hello, the default async
+    config) need it too, since a session connection has moved past both.
+    """
+    cls._fresh_controller = True
+    setUp = cls.setUp
+    def fn(self):
+        import oftest.base_tests
+        oftest.base_tests.session_controller_close()
+        setUp(self)
+    cls.setUp = fn
+    return cls
+
+def dataplane_queue_len(length):
+    """
+    Testcase decorator that sets the depth of the dataplane port queues
+    for the test, e.g. to receive a burst of packets without drops.
+    """
+    def fn(cls):
+        cls._dataplane_queue_len = length
+        return cls
+    return fn
+
 def group(name):
     """
     Testcase decorator that adds the test to a group.
@@ -1600,28 +1628,40 @@ assert(parse_version("1.0") == set(["1.0"]))
 assert(parse_version("1.0,1.2,1.3") == set(["1.0", "1.2", "1.3"]))
 assert(parse_version("1.0+") == set(["1.0", "1.1", "1.2", "1.3"]))
 
+def get_stats_iter(test, req):
+    """
+    Iterate over the stats entries of a request. Handles OFPSF_REPLY_MORE.
+
+    Entries are yielded as each reply arrives, so large tables can be
+    processed without holding the whole response in memory.
+    """
+    msgtype = ofp.OFPT_STATS_REPLY
+    stream = test.controller.multipart(req)
+    test.assertTrue(stream is not None, "Failed to send stats request")
+    try:
+        count = 0
+        for reply, _ in stream:
+            test.assertEquals(reply.type, msgtype, "Response had unexpected message type")
+            count += 1
+            for entry in reply.entries:
+                yield entry
+        test.assertTrue(not stream.parse_error, "Could not parse stats reply")
+        test.assertTrue(count > 0 and not stream.timed_out,
+                        "No response to stats request")
+    finally:
+        stream.close()
+
 def get_stats(test, req):
     """
     Retrieve a list of stats entries. Handles OFPSF_REPLY_MORE.
     """
-    msgtype = ofp.OFPT_STATS_REPLY
-    more_flag = ofp.OFPSF_REPLY_MORE
-    stats = []
-    reply, _ = test.controller.transact(req)
-    test.assertTrue(reply is not None, "No response to stats request")
-    test.assertEquals(reply.type, msgtype, "Response had unexpected message type")
-    stats.extend(reply.entries)
-    while reply.flags & more_flag != 0:
-        reply, pkt = test.controller.poll(exp_msg=msgtype)
-        test.assertTrue(reply is not None, "No response to stats request")
-        stats.extend(reply.entries)
-    return stats
+    return list(get_stats_iter(test, req))
 
-def get_flow_stats(test, match, table_id=None,
-                   out_port=None, out_group=None,
-                   cookie=0, cookie_mask=0):
+def get_flow_stats_iter(test, match, table_id=None,
+                        out_port=None, out_group=None,
+                        cookie=0, cookie_mask=0):
     """
-    Retrieve a list of flow stats entries.
+    Iterate over flow stats entries.
     """
 
     if table_id == None:
@@ -1648,21 +1688,43 @@ def get_flow_stats(test, match, table_id=None,
         req.cookie = cookie
         req.cookie_mask = cookie_mask
 
-    return get_stats(test, req)
+    return get_stats_iter(test, req)
+
+def get_flow_stats(test, match, table_id=None,
+                   out_port=None, out_group=None,
+                   cookie=0, cookie_mask=0):
+    """
+    Retrieve a list of flow stats entries.
+    """
+    return list(get_flow_stats_iter(test, match, table_id=table_id,
+                                    out_port=out_port, out_group=out_group,
+                                    cookie=cookie, cookie_mask=cookie_mask))
+
+def get_port_stats_iter(test, port_no):
+    """
+    Iterate over port stats entries.
+    """
+    req = ofp.message.port_stats_request(port_no=port_no)
+    return get_stats_iter(test, req)
 
 def get_port_stats(test, port_no):
     """
     Retrieve a list of port stats entries.
     """
-    req = ofp.message.port_stats_request(port_no=port_no)
-    return get_stats(test, req)
+    return list(get_port_stats_iter(test, port_no))
+
+def get_queue_stats_iter(test, port_no, queue_id):
+    """
+    Iterate over queue stats entries.
+    """
+    req = ofp.message.queue_stats_request(port_no=port_no, queue_id=queue_id)
+    return get_stats_iter(test, req)
 
 def get_queue_stats(test, port_no, queue_id):
     """
     Retrieve a list of queue stats entries.
     """
-    req = ofp.message.queue_stats_request(port_no=port_no, queue_id=queue_id)
-    return get_stats(test, req)
+    return list(get_queue_stats_iter(test, port_no, queue_id))
 
 def verify_flow_stats(test, match, table_id=0xff,
                       initial=[],
@@ -1687,7 +1749,7 @@ def verify_flow_stats(test, match, table_id=0xff,
     # Wait 10s for counters to update
     pkt_diff = byte_diff = None
     for i in range(0, 100):
-        stats = get_flow_stats(test, match, table_id=table_id)
+        stats = get_flow_stats_iter(test, match, table_id=table_id)
         pkts_after, bytes_after = accumulate(stats)
         pkt_diff = pkts_after - pkts_before
         byte_diff = bytes_after - bytes_before
@@ -1728,7 +1790,7 @@ def verify_port_stats(test, port,
 
     # Wait 10s for counters to update
     for i in range(0, 100):
-        stats = get_port_stats(test, port)
+        stats = get_port_stats_iter(test, port)
         tx_pkts_after, rx_pkts_after, \
             tx_bytes_after, rx_bytes_after = accumulate(stats)
         tx_pkts_diff = tx_pkts_after - tx_pkts_before
@@ -1777,7 +1839,7 @@ def verify_queue_stats(test, port_no, queue_id,
     # Wait 10s for counters to update
     pkt_diff = byte_diff = None
     for i in range(0, 100):
-        stats = get_queue_stats(test, port_no, queue_id)
+        stats = get_queue_stats_iter(test, port_no, queue_id)
         pkts_after, bytes_after = accumulate(stats)
         pkt_diff = pkts_after - pkts_before
         byte_diff = bytes_after - bytes_before
@@ -0,0 +1,165 @@
+"""
+Control channel transports
+
+A transport creates the sockets the controller talks to switches over.
+The controller either listens for switches to connect (passive) or makes
+the connection itself (active).
+
+TcpTransport is the default.  UnixTransport uses a UNIX stream socket,
+which local software switches can use with less overhead.
+SocketpairTransport connects the controller to the other end of an
+in-process socketpair, so a switch implemented in the test process can
+be used without any network setup.
+"""
+
+import os
+import socket
+import errno
+
+class TcpTransport(object):
+    """
+    OpenFlow over TCP
+
+    @var host The address to listen on, or the switch address if active
+    @var port The port to listen on or connect to
+    @var passive True to listen for switch connections
+    """
+
+    def __init__(self, host='127.0.0.1', port=6653, switch=None):
+        """
+        @param host The address to listen on
+        @param port The port to listen on or connect to
+        @param switch If not None, actively connect to this switch address
+        """
+        self.port = port
+        self.passive = not switch
+        if self.passive:
+            self.host = host
+        else:
+            self.host = switch
+
+    def listen(self, backlog):
+        """
+        Create the listening socket
+
+        @param backlog The size of the queue of pending connections
+        @returns A socket ready for accept()
+        """
+        ai = socket.getaddrinfo(self.host, self.port, socket.AF_UNSPEC,
+                                socket.SOCK_STREAM, 0, socket.AI_PASSIVE)
+        # Use first returned addrinfo
+        (family, socktype, proto, name, sockaddr) = ai[0]
+        sock = socket.socket(family, socktype)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(sockaddr)
+        sock.listen(backlog)
+        return sock
+
+    def connect(self):
+        """
+        Connect to the switch
+
+        @returns A pair (sock, addr)
+        @raises socket.error if the connection failed
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((self.host, self.port))
+        self.setup(sock)
+        return (sock, (self.host, self.port))
+
+    def setup(self, sock):
+        """
+        Configure a connected socket
+        """
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, True)
+
+    def close(self):
+        pass
+
+    def __str__(self):
+        return "%s:%s" % (self.host, self.port)
+
+class UnixTransport(object):
+    """
+    OpenFlow over a UNIX stream socket
+
+    @var path The filesystem path of the socket
+    @var passive True to listen for switch connections
+    """
+
+    def __init__(self, path, active=False):
+        """
+        @param path The filesystem path of the socket
+        @param active If true, connect to a switch listening on path
+        instead of listening on it
+        """
+        self.path = path
+        self.passive = not active
+        self.bound = False
+
+    def listen(self, backlog):
+        # Remove a socket left behind by an earlier run
+        try:
+            os.unlink(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        sock.listen(backlog)
+        self.bound = True
+        return sock
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        return (sock, self.path)
+
+    def setup(self, sock):
+        pass
+
+    def close(self):
+        """
+        Remove the socket file created by listen
+        """
+        if self.bound:
+            self.bound = False
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def __str__(self):
+        return "unix:" + self.path
+
+class SocketpairTransport(object):
+    """
+    OpenFlow over an in-process socketpair
+
+    Each connect() creates a new socketpair; the controller gets one end
+    and the other is left in peer for the switch.
+
+    @var peer The switch end of the most recent socketpair, or None
+    """
+
+    passive = False
+
+    def __init__(self):
+        self.peer = None
+
+    def listen(self, backlog):
+        raise socket.error(errno.EOPNOTSUPP,
+                           "socketpair transport cannot listen")
+
+    def connect(self):
+        sock, self.peer = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        return (sock, "socketpair")
+
+    def setup(self, sock):
+        pass
+
+    def close(self):
+        pass
+
+    def __str__(self):
+        return "socketpair"
@@ -548,6 +548,7 @@ class PortConfigMod(base_tests.SimpleProtocol):
                              ofp.OFPPC_NO_PACKET_IN)
         self.assertTrue(rv != -1, "Error sending port mod")
 
+@fresh_controller
 class AsyncConfigGet(base_tests.SimpleProtocol):
     """
     Verify initial async config
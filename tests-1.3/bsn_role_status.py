@@ -32,6 +32,7 @@ def simple_role_request(test, role, gen=None, con=None):
 
 @disabled
 @nonstandard
+@fresh_controller
 class RoleStatus(unittest.TestCase):
     """
     Verify that when a connection becomes a master the existing master is
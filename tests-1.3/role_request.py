@@ -42,6 +42,7 @@ def failed_role_request(test, role, gen, code, con=None):
     test.assertIsInstance(response, ofp.message.role_request_failed_error_msg)
     test.assertEqual(response.code, code)
 
+@fresh_controller
 class RoleRequestNochange(base_tests.SimpleDataPlane):
     """
     Verify that we can query the switch for our current role and generation ID
@@ -57,6 +58,7 @@ class RoleRequestNochange(base_tests.SimpleDataPlane):
         self.assertEqual(role, ofp.OFPCR_ROLE_EQUAL)
         self.assertEqual(new_gen, gen)
 
+@fresh_controller
 class RoleRequestEqualToSlave(base_tests.SimpleDataPlane):
     """
     Transition between equal and slave roles and back
@@ -104,6 +106,7 @@ class RoleRequestEqualToSlave(base_tests.SimpleDataPlane):
         self.assertEqual(role, ofp.OFPCR_ROLE_EQUAL)
         self.assertEqual(gen, gen3)
 
+@fresh_controller
 class RoleRequestEqualToMaster(base_tests.SimpleDataPlane):
     """
     Transition between equal and master roles and back
@@ -151,6 +154,7 @@ class RoleRequestEqualToMaster(base_tests.SimpleDataPlane):
         self.assertEqual(role, ofp.OFPCR_ROLE_EQUAL)
         self.assertEqual(gen, gen3)
 
+@fresh_controller
 class RoleRequestSlaveToMaster(base_tests.SimpleDataPlane):
     """
     Transition between slave and master roles and back
@@ -202,6 +206,7 @@ class RoleRequestSlaveToMaster(base_tests.SimpleDataPlane):
         self.assertEqual(role, ofp.OFPCR_ROLE_SLAVE)
         self.assertEqual(gen, gen4)
 
+@fresh_controller
 class RolePermissions(base_tests.SimpleDataPlane):
     """
     Verify that a slave connection cannot modify switch state, but
@@ -255,6 +260,7 @@ class RolePermissions(base_tests.SimpleDataPlane):
         else:
             self.assertEquals(err_count, 3, "Expected errors for each message")
 
+@fresh_controller
 class SlaveNoPacketIn(base_tests.SimpleDataPlane):
     """
     Verify that slave connections do not receive OFPT_PACKET_IN messages but other roles do.
@@ -293,6 +299,7 @@ class SlaveNoPacketIn(base_tests.SimpleDataPlane):
         verify_packet_in(self, pkt, ingress_port, ofp.OFPR_NO_MATCH)
 
 @disabled
+@fresh_controller
 class RoleSwitch(unittest.TestCase):
     """
     Verify that when a connection becomes a master the existing master is
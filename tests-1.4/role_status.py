@@ -29,6 +29,7 @@ def simple_role_request(test, role, gen=None, con=None):
     return response.role, response.generation_id
 
 @disabled
+@fresh_controller
 class RoleStatus(unittest.TestCase):
     """
     Verify that when a connection becomes a master the existing master is
@@ -18,6 +18,7 @@ import oftest.dataplane as dataplane
 from oftest.testutils import *
 
 @disabled
+@fresh_controller
 class BaseHandshake(unittest.TestCase):
     """
     Base handshake case to set up controller, but do not send hello.
@@ -125,9 +125,7 @@ class PacketInLoad(base_tests.SimpleDataPlane):
                (simple_eth_packet(pktlen=40), "tiny Ethernet packet")]:
 
                logging.info("PKT IN test with %s, port %s" % (pt, of_port))
-               for count in range(100):
-                   out_count += 1
-                   self.dataplane.send(of_port, str(pkt))
+               out_count += self.dataplane.send_many(of_port, [str(pkt)] * 100)
         while True:
             (response, raw) = self.controller.poll(ofp.OFPT_PACKET_IN)
             if not response:
@@ -175,11 +173,13 @@ class PacketOutLoad(base_tests.SimpleDataPlane):
                msg.buffer_id = 0xffffffff
 
                logging.info("PacketOutLoad to: " + str(dp_port))
+               self.controller.cork()
                for count in range(100):
                    msg.xid = xid
                    xid += 1
                    self.controller.message_send(msg)
                    out_count += 1
+               self.controller.uncork()
 
                exp_pkt_arg = None
                exp_port = None
@@ -231,9 +231,7 @@ class FlowModLoad(base_tests.SimpleProtocol):
 
             logging.info("Iteration %d: add %s flows" % (i, num_flows))
             random.shuffle(requests)
-            for request in requests:
-               self.assertNotEqual(self.controller.message_send(request), -1,
-                               "Error installing flow mod")
+            self.controller.message_send_many(requests)
             self.checkBarrier()
 
 class FlowRemovedLoad(base_tests.SimpleDataPlane):
@@ -282,8 +280,7 @@ class FlowRemovedLoad(base_tests.SimpleDataPlane):
 
         logging.info("Adding %d flows", num_flows)
         random.shuffle(requests)
-        for request in requests:
-            self.controller.message_send(request)
+        self.controller.message_send_many(requests)
         self.checkBarrier()
 
         # Trigger a flood of flow-removed messages
@@ -23,6 +23,7 @@ from FuncUtils import*
 
 
 @disabled
+@fresh_controller
 class HelloWithBody(base_tests.SimpleDataPlane):
 
     """Verify switch should be able to receive OFPT_HELLO messages with body , 
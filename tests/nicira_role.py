@@ -25,6 +25,7 @@ def set_role(test, role, con=None):
     test.assertTrue(isinstance(response, ofp.message.nicira_controller_role_reply), "Expected a role reply")
     test.assertEquals(response.role, role)
 
+@fresh_controller
 class AnyReply(base_tests.SimpleDataPlane):
     """
     Verify that a role request gets either a role reply or an error.
@@ -48,6 +49,7 @@ class AnyReply(base_tests.SimpleDataPlane):
             raise AssertionError("Unexpected reply type")
 
 @nonstandard
+@fresh_controller
 class RolePermissions(base_tests.SimpleDataPlane):
     """
     Verify that a slave connection cannot modify switch state, but
@@ -89,6 +91,7 @@ class RolePermissions(base_tests.SimpleDataPlane):
             self.assertEquals(err_count, 3, "Expected errors for each message")
 
 @nonstandard
+@fresh_controller
 class SlaveNoPacketIn(base_tests.SimpleDataPlane):
     """
     Verify that slave connections do not receive OFPT_PACKET_IN messages but other roles do.
@@ -112,6 +115,7 @@ class SlaveNoPacketIn(base_tests.SimpleDataPlane):
 
 @nonstandard
 @disabled
+@fresh_controller
 class RoleSwitch(unittest.TestCase):
     """
     Verify that when a connection becomes a master the existing master is
@@ -187,6 +191,7 @@ class RoleSwitch(unittest.TestCase):
 
 @nonstandard
 @disabled
+@fresh_controller
 class EqualAsyncMessages(unittest.TestCase):
     """
     Verify that 'equal' controllers all get async events.